@@ -0,0 +1,597 @@
+"""
+Офлайн-бенчмарк конвертеров и объединения.
+
+Генерирует детерминированный синтетический корпус (TXT, FB2 с изображениями в <binary>,
+EPUB со spine и изображениями, DOCX с разными стилями) нескольких размеров, прогоняет
+по нему этапы бота и пишет в JSON время и память каждого этапа. Время меряется в текущем
+процессе; пик RSS (peak_rss_mb) — в отдельном дочернем процессе на каждый этап, вместе
+с памятью C-расширений (lxml, PIL); peak_py_heap_mb — только куча Python по tracemalloc.
+Токен Telegram и сеть не нужны.
+
+    python bench.py                                  # small и medium, результаты в bench_results.json
+    python bench.py --sizes small,medium,large --repeat 5
+    python bench.py --output new.json --compare bench_results.json  # сравнение с прошлым коммитом
+
+Этапы *_legacy — замороженные копии прежних реализаций (для EPUB нужен beautifulsoup4):
+в их строках speedup — во сколько раз текущий этап быстрее.
+"""
+import os
+import sys
+import io
+import gc
+import base64
+import json
+import time
+import random
+import shutil
+import zipfile
+import asyncio
+import argparse
+import posixpath
+import platform
+import statistics
+import subprocess
+import tempfile
+import resource
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape as xml_escape
+
+# Бот при импорте создает базы и каталоги: в бенчмарке кэш и рабочие каталоги — во временном
+# каталоге. Дочерние процессы замера памяти импортируют этот модуль заново и наследуют пути
+# родителя через окружение, поэтому свой каталог создается, только если пути еще не заданы.
+WORK_DIR = None  # Каталог, созданный этим процессом (mkdtemp); удаляется в main()
+if not (os.environ.get("CACHE_DIR") and os.environ.get("WORKSPACE_ROOT")):
+    WORK_DIR = tempfile.mkdtemp(prefix="bench_")
+    os.environ.setdefault("CACHE_DIR", os.path.join(WORK_DIR, "cache"))
+    os.environ.setdefault("WORKSPACE_ROOT", os.path.join(WORK_DIR, "workspaces"))
+os.environ.setdefault("TASK_QUEUE_BACKEND", "memory")
+os.environ.setdefault("LIMITS_DB", "")
+os.environ.setdefault("DELETIONS_DB", ":memory:")
+os.environ.setdefault("CACHE_MAX_MB", "0")
+os.environ.setdefault("TRACE_FILE", "")
+
+import bot
+from docx import Document
+from docx.shared import Inches
+from PIL import Image
+try:
+    from bs4 import BeautifulSoup  # Только для прежней реализации EPUB (база сравнения)
+except ImportError:
+    BeautifulSoup = None
+
+# Размеры корпуса: абзацев и изображений в каждом файле, глав в EPUB и FB2
+SIZES = {
+    "small": {"paragraphs": 300, "images": 2, "chapters": 3},
+    "medium": {"paragraphs": 3000, "images": 12, "chapters": 10},
+    "large": {"paragraphs": 30000, "images": 40, "chapters": 30},
+}
+IMAGE_SHAPES = [(640, 480), (1200, 900), (2400, 1800), (800, 1200)]
+
+WORDS = ("книга глава история город время человек дорога вечер письмо окно река лес дом свет "
+         "ветер память слово голос утро ночь море поле огонь небо друг путь сердце мысль "
+         "старый новый тихий длинный белый темный быстро медленно вдруг снова всегда никогда").split()
+
+# ===================== Генератор корпуса =====================
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 16))]
+    return " ".join(words).capitalize() + rng.choice(".!?…")
+
+def paragraph_text(rng):
+    return " ".join(sentence(rng) for _ in range(rng.randint(1, 5)))
+
+def make_image(rng, index):
+    """Изображение из шума низкого разрешения, растянутого до нужного размера: JPEG или PNG."""
+    width, height = rng.choice(IMAGE_SHAPES)
+    small = Image.frombytes("RGB", (32, 24), rng.randbytes(32 * 24 * 3))
+    image = small.resize((width, height), Image.BICUBIC)
+    buffer = io.BytesIO()
+    if index % 3 == 2:
+        image.save(buffer, "PNG", compress_level=1)
+        return buffer.getvalue(), "png"
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue(), "jpeg"
+
+def chapters(rng, spec):
+    """Главы: (заголовок, [абзацы]); изображения распределяются по главам равномерно."""
+    per_chapter = max(1, spec["paragraphs"] // spec["chapters"])
+    return [(f"Глава {number}", [paragraph_text(rng) for _ in range(per_chapter)])
+            for number in range(1, spec["chapters"] + 1)]
+
+def image_positions(spec):
+    """Номера абзацев (сквозные), после которых стоят изображения."""
+    step = max(1, spec["paragraphs"] // (spec["images"] + 1))
+    return {step * (i + 1): i for i in range(spec["images"])}
+
+def write_txt(path, rng, spec, encoding):
+    with open(path, "w", encoding=encoding, errors="replace") as f:
+        for title, paragraphs in chapters(rng, spec):
+            f.write(title + "\n\n")
+            for text in paragraphs:
+                f.write(text + "\n")
+            f.write("\n")
+
+def write_fb2(path, rng, spec):
+    positions = image_positions(spec)
+    images = [make_image(rng, i) for i in range(spec["images"])]
+    out = ['<?xml version="1.0" encoding="utf-8"?>',
+           '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">',
+           '<description><title-info><book-title>Синтетическая книга</book-title>',
+           f'<annotation><p>{xml_escape(paragraph_text(rng))}</p></annotation></title-info></description>',
+           '<body>']
+    counter = 0
+    for title, paragraphs in chapters(rng, spec):
+        out.append(f'<section><title><p>{title}</p></title>')
+        for text in paragraphs:
+            counter += 1
+            words = text.split(" ")
+            cut = rng.randint(1, len(words))
+            style = rng.choice(("strong", "emphasis", None))
+            if style:
+                out.append(f'<p>{xml_escape(" ".join(words[:cut]))} <{style}>{xml_escape(" ".join(words[cut:]))}</{style}></p>')
+            else:
+                out.append(f'<p>{xml_escape(text)}</p>')
+            if counter in positions:
+                out.append(f'<image l:href="#img{positions[counter]}"/>')
+        out.append('</section>')
+    out.append('</body>')
+    for i, (data, kind) in enumerate(images):
+        encoded = base64.encodebytes(data).decode("ascii")
+        out.append(f'<binary id="img{i}" content-type="image/{kind}">{encoded}</binary>')
+    out.append('</FictionBook>')
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(out))
+
+def _zip_write(archive, name, data, compress=zipfile.ZIP_DEFLATED):
+    # Постоянная дата в архиве: одинаковый seed дает побайтно одинаковый EPUB
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = compress
+    archive.writestr(info, data)
+
+def write_epub(path, rng, spec):
+    positions = image_positions(spec)
+    images = [make_image(rng, i) for i in range(spec["images"])]
+    manifest, spine, documents = [], [], []
+    counter = 0
+    for number, (title, paragraphs) in enumerate(chapters(rng, spec), 1):
+        body = [f"<h1>{title}</h1>"]
+        for text in paragraphs:
+            counter += 1
+            kind = rng.random()
+            if kind < 0.05:
+                body.append(f"<h2>{xml_escape(sentence(rng))}</h2>")
+            elif kind < 0.1:
+                body.append("<ul>" + "".join(f"<li>{xml_escape(sentence(rng))}</li>" for _ in range(3)) + "</ul>")
+            elif kind < 0.15:
+                body.append(f"<blockquote><p>{xml_escape(text)}</p></blockquote>")
+            words = text.split(" ")
+            cut = rng.randint(1, len(words))
+            body.append(f"<p>{xml_escape(' '.join(words[:cut]))} <b>{xml_escape(rng.choice(WORDS))}</b> "
+                        f"<i>{xml_escape(' '.join(words[cut:]))}</i></p>")
+            if counter in positions:
+                index = positions[counter]
+                extension = "jpg" if images[index][1] == "jpeg" else "png"
+                body.append(f'<p><img src="images/img{index}.{extension}" alt="img{index}"/></p>')
+        name = f"chapter{number}.xhtml"
+        documents.append((name, '<?xml version="1.0" encoding="utf-8"?>\n'
+                          '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>' + title + '</title></head>'
+                          '<body>' + "\n".join(body) + '</body></html>'))
+        manifest.append(f'<item id="ch{number}" href="{name}" media-type="application/xhtml+xml"/>')
+        spine.append(f'<itemref idref="ch{number}"/>')
+    for index, (data, kind) in enumerate(images):
+        extension = "jpg" if kind == "jpeg" else "png"
+        manifest.append(f'<item id="img{index}" href="images/img{index}.{extension}" media-type="image/{kind}"/>')
+    opf = ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+           '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">bench</dc:identifier>'
+           '<dc:title>Синтетическая книга</dc:title><dc:language>ru</dc:language></metadata>'
+           '<manifest>' + "".join(manifest) + '</manifest><spine>' + "".join(spine) + '</spine></package>')
+    container = ('<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                 '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+    with zipfile.ZipFile(path, "w") as archive:
+        _zip_write(archive, "mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        _zip_write(archive, "META-INF/container.xml", container)
+        _zip_write(archive, "OEBPS/content.opf", opf)
+        for name, content in documents:
+            _zip_write(archive, "OEBPS/" + name, content)
+        for index, (data, kind) in enumerate(images):
+            extension = "jpg" if kind == "jpeg" else "png"
+            _zip_write(archive, f"OEBPS/images/img{index}.{extension}", data, zipfile.ZIP_STORED)
+
+def write_docx(path, rng, spec):
+    positions = image_positions(spec)
+    document = Document()
+    document.core_properties.created = datetime(2000, 1, 1)
+    document.add_heading("Синтетический документ", level=0)
+    counter = 0
+    for title, paragraphs in chapters(rng, spec):
+        document.add_heading(title, level=1)
+        for text in paragraphs:
+            counter += 1
+            kind = rng.random()
+            if kind < 0.05:
+                document.add_heading(sentence(rng), level=2)
+            elif kind < 0.1:
+                document.add_paragraph(sentence(rng), style="List Bullet")
+            elif kind < 0.13:
+                document.add_paragraph(text, style="Quote")
+            elif kind < 0.14:
+                table = document.add_table(rows=3, cols=3)
+                for cell in table._cells:
+                    cell.text = rng.choice(WORDS)
+            p = document.add_paragraph()
+            words = text.split(" ")
+            start = 0
+            while start < len(words):
+                end = start + rng.randint(2, 8)
+                run = p.add_run(" ".join(words[start:end]) + " ")
+                style = rng.random()
+                if style < 0.15:
+                    run.bold = True
+                elif style < 0.3:
+                    run.italic = True
+                elif style < 0.35:
+                    run.underline = True
+                start = end
+            if counter in positions:
+                data, _ = make_image(rng, positions[counter])
+                document.add_picture(io.BytesIO(data), width=Inches(4))
+    document.save(path)
+
+GENERATORS = {
+    "txt": lambda path, rng, spec: write_txt(path, rng, spec, "utf-8"),
+    "fb2": write_fb2,
+    "epub": write_epub,
+    "docx": write_docx,
+}
+
+def generate_corpus(directory, sizes, seed):
+    """
+    Создает корпус в directory. Содержимое зависит только от seed, размера и формата:
+    у каждого файла свой генератор случайных чисел. Возвращает описания файлов.
+    """
+    corpus = []
+    for size in sizes:
+        spec = SIZES[size]
+        for file_format, generator in GENERATORS.items():
+            path = os.path.join(directory, f"{size}.{file_format}")
+            generator(path, random.Random(f"{seed}:{size}:{file_format}"), spec)
+            corpus.append({"input": os.path.basename(path), "path": path, "format": file_format, "size": size,
+                           "bytes": os.path.getsize(path), "images": 0 if file_format == "txt" else spec["images"]})
+        # Текст в cp1251: проверка определения кодировки на том же объеме
+        path = os.path.join(directory, f"{size}-cp1251.txt")
+        write_txt(path, random.Random(f"{seed}:{size}:txt"), spec, "cp1251")
+        corpus.append({"input": os.path.basename(path), "path": path, "format": "txt", "size": size,
+                       "bytes": os.path.getsize(path), "images": 0})
+    return corpus
+
+# ===================== Прежние реализации =====================
+# Замороженные копии путей, которые заменили оптимизации: база, с которой сравниваются
+# текущие этапы. Не менять вместе с ботом.
+
+def legacy_epub_emit(epub_file):
+    """EPUB до HtmlDocxEmitter: BeautifulSoup (html.parser), find_all и add_paragraph. Без сохранения."""
+    document = Document()
+    book = bot.open_epub(epub_file)
+    chapters = 0
+    try:
+        for doc_name, content in book.documents():
+            chapters += 1
+            soup = BeautifulSoup(content, 'html.parser')
+            html_base_path = posixpath.dirname(doc_name)
+            for element in soup.find_all():
+                if element.name == 'h1':
+                    document.add_heading(element.get_text(), level=1)
+                elif element.name == 'p':
+                    doc_paragraph = document.add_paragraph()
+                    for sub in element.contents:
+                        if hasattr(sub, 'name'):
+                            if sub.name == 'strong':
+                                run = doc_paragraph.add_run(sub.get_text())
+                                run.bold = True
+                            elif sub.name == 'em':
+                                run = doc_paragraph.add_run(sub.get_text())
+                                run.italic = True
+                            else:
+                                doc_paragraph.add_run(sub.get_text())
+                        else:
+                            doc_paragraph.add_run(sub)
+                elif element.name == 'img':
+                    src = element.get('src')
+                    if src:
+                        image_stream = book.open_image(book.resolve(html_base_path, src))
+                        if image_stream is not None:
+                            with image_stream:
+                                f = io.BytesIO()
+                                Image.open(image_stream).convert('RGB').save(f, format='JPEG', quality=70)
+                            document.add_picture(f, width=Inches(5.5))
+    finally:
+        book.close()
+    return chapters
+
+def epub_emit(epub_file):
+    """Текущий путь EPUB до того же места: разбор и вывод глав в документ, без сохранения."""
+    bot.render_model(bot._convert_epub(epub_file), Document())
+
+def legacy_txt_to_docx(txt_file, docx_file):
+    """TXT до потоковой записи: весь файл как UTF-8 и add_paragraph на каждую строку."""
+    try:
+        with open(txt_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except UnicodeDecodeError:
+        return False  # cp1251 и koi8-r прежний путь не читал
+    document = Document()
+    for line in text.splitlines():
+        document.add_paragraph(line)
+    document.save(docx_file)
+    return True
+
+def epub_chapters(epub_file):
+    book = bot.open_epub(epub_file)
+    try:
+        return sum(1 for _ in book.documents())
+    finally:
+        book.close()
+
+# ===================== Очередь задач =====================
+QUEUE_PRODUCERS = 50  # Пользователей, одновременно ставящих задачи
+QUEUE_FILES = [f"file{i}.txt" for i in range(10)]  # Файлы задачи (несуществующие: стоимость 0)
+
+def queue_throughput(backend, tasks, db_path):
+    """
+    Продюсеры (по одному на пользователя) и потребитель в одном цикле событий, как в боте:
+    tasks раз add_task, get_next_task и complete_task. backend — "memory" или "sqlite".
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    queue = bot.TaskQueue(1) if backend == "memory" else bot.SqliteTaskQueue(1, db_path)
+
+    async def producer(user_id):
+        for _ in range(tasks // QUEUE_PRODUCERS):
+            queue.add_task(user_id, user_id, None, False, QUEUE_FILES, "out.docx", "workspace")
+            await asyncio.sleep(0)
+
+    async def consumer():
+        done = 0
+        while done < tasks // QUEUE_PRODUCERS * QUEUE_PRODUCERS:
+            task = queue.get_next_task()
+            if task is None:
+                await asyncio.sleep(0)
+                continue
+            queue.complete_task(task['task_id'])
+            done += 1
+
+    async def run():
+        await asyncio.gather(consumer(), *(producer(user_id) for user_id in range(QUEUE_PRODUCERS)))
+
+    try:
+        asyncio.run(run())
+    finally:
+        if backend == "sqlite":
+            queue.db.close()
+
+# ===================== Измерения =====================
+def _status_mb(field):
+    """Поле VmRSS/VmHWM из /proc/self/status в МБ."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise OSError(field)
+
+def _peak_rss(func, args):
+    """
+    Выполняется в дочернем процессе: RSS до запуска func и пик RSS за время func (МБ).
+    Пик после импорта бота сбрасывается через /proc/self/clear_refs (Linux), иначе
+    пик берется из ru_maxrss и включает сам импорт.
+    """
+    bot.clear_image_memo()
+    gc.collect()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # Сбросить VmHWM до текущего RSS
+        base = _status_mb("VmRSS")
+        proc = True
+    except OSError:
+        # На Linux ru_maxrss в килобайтах
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        proc = False
+    func(*args)
+    return base, _status_mb("VmHWM") if proc else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(func, args, repeat, rss_pool):
+    """
+    Время repeat запусков func(*args), пик кучи Python (tracemalloc) в отдельном запуске,
+    чтобы трассировка памяти не искажала время, и пик RSS в свежем дочернем процессе
+    из rss_pool. Перед каждым запуском сбрасывается кэш перекодированных изображений.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        bot.clear_image_memo()
+        gc.collect()
+        start_time = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start_time)
+    bot.clear_image_memo()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    base_rss, peak_rss = rss_pool.submit(_peak_rss, func, args).result()
+    return result, {
+        "times_s": [round(t, 6) for t in times],
+        "min_s": round(min(times), 6),
+        "median_s": round(statistics.median(times), 6),
+        "peak_rss_mb": round(peak_rss, 1),
+        "base_rss_mb": round(base_rss, 1),  # RSS дочернего процесса до этапа (интерпретатор и импорт бота)
+        "peak_py_heap_mb": round(peak / 1024 / 1024, 3),
+    }
+
+def run_benchmarks(corpus, repeat, directory, legacy=True, queue_tasks=20000):
+    """
+    Прогоняет этапы по корпусу и очередь задач на queue_tasks задачах;
+    legacy — замерять и прежние реализации для сравнения.
+    """
+    results = []
+
+    def report(stage, item, stats, **extra):
+        row = {"stage": stage, "input": item["input"], "format": item["format"], "size": item["size"],
+               "bytes": item["bytes"], "images": item["images"], **extra, **stats}
+        results.append(row)
+        print(f"{stage:16} {item['input']:20} {row['median_s']:9.3f} с  RSS {row['peak_rss_mb']:8.1f} МБ  "
+              f"куча Python {row['peak_py_heap_mb']:8.1f} МБ", flush=True)
+
+    sizes = sorted({item["size"] for item in corpus}, key=list(SIZES).index)
+    # Каждый замер RSS — в новом процессе: ru_maxrss только растет и иначе копился бы между этапами
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1) as rss_pool:
+        for size in sizes:
+            items = [item for item in corpus if item["size"] == size]
+            merge_inputs = []
+            for item in items:
+                if item["format"] == "docx":
+                    merge_inputs.append(item["path"])
+                    continue
+                # То, что делает воркер пула: модель DocModel в pickle
+                (converted, blob, info), stats = measure(bot._convert_to_model_blob, (item["path"],), repeat, rss_pool)
+                report("convert", item, stats, paragraphs=info["paragraphs"], converted=converted)
+                merge_inputs.append(blob)
+                # Конвертация в отдельный .docx, как до перехода на модели
+                docx_file = os.path.join(directory, f"{item['input']}.docx")
+                _, stats = measure(bot._convert_to_docx, (item["path"], docx_file), repeat, rss_pool)
+                report("convert_to_docx", item, stats, paragraphs=info["paragraphs"])
+                if item["format"] == "txt" and legacy:
+                    # Прежняя запись TXT против текущей (_convert_to_docx выше), обе с сохранением .docx
+                    current = stats["min_s"]
+                    legacy_file = os.path.join(directory, f"{item['input']}.legacy.docx")
+                    converted, stats = measure(legacy_txt_to_docx, (item["path"], legacy_file), repeat, rss_pool)
+                    if converted:
+                        report("txt_legacy", item, stats, paragraphs=info["paragraphs"], speedup=round(stats["min_s"] / current, 2))
+                if item["format"] == "epub":
+                    # Разбор и вывод глав: текущий HtmlDocxEmitter против прежнего BeautifulSoup
+                    chapters = epub_chapters(item["path"])
+                    _, stats = measure(epub_emit, (item["path"],), repeat, rss_pool)
+                    report("epub_emit", item, stats, chapters=chapters, per_chapter_s=round(stats["min_s"] / chapters, 6))
+                    current = stats["min_s"]
+                    if legacy and BeautifulSoup is not None:
+                        _, stats = measure(legacy_epub_emit, (item["path"],), repeat, rss_pool)
+                        report("epub_emit_legacy", item, stats, chapters=chapters,
+                               per_chapter_s=round(stats["min_s"] / chapters, 6), speedup=round(stats["min_s"] / current, 2))
+                    elif legacy:
+                        print("epub_emit_legacy пропущен: не установлен beautifulsoup4")
+            # Объединение всех файлов размера: модели выводятся напрямую, DOCX идет через Composer
+            output = os.path.join(directory, f"{size}-merged.docx")
+            merged = {"input": f"{size}-merged", "format": "docx", "size": size,
+                      "bytes": sum(item["bytes"] for item in items), "images": sum(item["images"] for item in items)}
+            names = [item["path"] for item in items]
+            _, stats = measure(bot._merge_docx, (merge_inputs, output, None, names), repeat, rss_pool)
+            report("merge", merged, stats, files=len(merge_inputs), output_bytes=os.path.getsize(output))
+        # Постановка и выборка задач под нагрузкой: очередь в памяти против SQLite (WAL)
+        for backend in ("memory", "sqlite"):
+            item = {"input": f"queue-{backend}", "format": "queue", "size": "-", "bytes": 0, "images": 0}
+            _, stats = measure(queue_throughput, (backend, queue_tasks, os.path.join(directory, "tasks.db")), repeat, rss_pool)
+            tasks = queue_tasks // QUEUE_PRODUCERS * QUEUE_PRODUCERS
+            report("queue", item, stats, tasks=tasks, producers=QUEUE_PRODUCERS, tasks_per_s=round(tasks / stats["min_s"]))
+    return results
+
+# ===================== Результаты =====================
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, threshold, min_delta):
+    """
+    Сравнивает с прошлым прогоном лучшее время (min_s, меньше всего шумит) и пик RSS.
+    Регрессия — рост больше чем в threshold раз и больше чем на min_delta секунд.
+    Возвращает число регрессий.
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(row["stage"], row["input"]): row for row in baseline["results"]}
+    print(f"\nСравнение с {baseline_path} (коммит {baseline['meta'].get('commit')}):")
+    regressions = 0
+    for row in results:
+        previous = old.get((row["stage"], row["input"]))
+        if previous is None or not previous["min_s"]:
+            continue
+        ratio = row["min_s"] / previous["min_s"]
+        memory_ratio = row["peak_rss_mb"] / previous["peak_rss_mb"] if previous.get("peak_rss_mb") else 1.0
+        slower = ratio > threshold and row["min_s"] - previous["min_s"] > min_delta
+        mark = ""
+        if slower or memory_ratio > threshold:
+            mark = "  <-- регрессия"
+            regressions += 1
+        print(f"{row['stage']:16} {row['input']:20} время x{ratio:5.2f}  память x{memory_ratio:5.2f}{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк конвертеров и объединения")
+    parser.add_argument("--sizes", default="small,medium", help=f"размеры корпуса через запятую: {', '.join(SIZES)}")
+    parser.add_argument("--repeat", type=int, default=3, help="запусков каждого этапа для замера времени")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора корпуса")
+    parser.add_argument("--output", default="bench_results.json", help="файл с результатами (JSON)")
+    parser.add_argument("--corpus-dir", help="сохранить корпус и результаты этапов в этот каталог")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.15, help="во сколько раз медленнее считается регрессией")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="прирост времени в секундах, меньше которого регрессии нет")
+    parser.add_argument("--queue-tasks", type=int, default=20000, help="задач в замере очереди")
+    parser.add_argument("--no-legacy", action="store_true", help="не замерять прежние реализации (на large они идут минутами)")
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"неизвестные размеры: {', '.join(unknown)}")
+
+    # Удаляются только каталоги, созданные здесь: --corpus-dir и заданные пути кэша не трогаются
+    temporary = [WORK_DIR] if WORK_DIR else []
+    if args.corpus_dir:
+        directory = args.corpus_dir
+        os.makedirs(directory, exist_ok=True)
+    else:
+        directory = tempfile.mkdtemp(prefix="bench_corpus_")
+        temporary.append(directory)
+    try:
+        start_time = time.perf_counter()
+        corpus = generate_corpus(directory, sizes, args.seed)
+        print(f"Корпус: {len(corpus)} файлов, {sum(item['bytes'] for item in corpus) / 1024 / 1024:.1f} МБ "
+              f"за {time.perf_counter() - start_time:.1f} с")
+        results = run_benchmarks(corpus, args.repeat, directory, legacy=not args.no_legacy, queue_tasks=args.queue_tasks)
+    finally:
+        for path in temporary:
+            shutil.rmtree(path, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "sizes": sizes,
+            "settings": {"IMAGE_DPI": bot.IMAGE_DPI, "IMAGE_JPEG_QUALITY": bot.IMAGE_JPEG_QUALITY,
+                         "IMAGE_WORKERS": bot.IMAGE_WORKERS, "EPUB_READER": bot.EPUB_READER},
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+    if args.compare and compare(results, args.compare, args.threshold, args.min_delta):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,46 +2,124 @@
 # -*- coding: utf-8 -*-
 
 # Установка зависимостей
-#!pip install python-docx docxcompose beautifulsoup4 ebooklib aiogram aiofiles nest_asyncio
+#!pip install python-docx docxcompose lxml ebooklib aiogram nest_asyncio pillow aiohttp
 
 import os
 import re
+import shutil
+import tempfile
 import time
 import docx
 import aiogram
 from docx import Document
 from docx.shared import Inches
+from docx.oxml import OxmlElement
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn, nsdecls
+from xml.sax.saxutils import escape as xml_escape
+from docx.text.paragraph import Paragraph
 from PIL import Image
 import io
 from io import BytesIO
 import base64
 import posixpath
+import hashlib
+import codecs
+import pickle
+import json
+import sqlite3
+import socket
+import threading
+import random
+import contextvars
+import cProfile
+import pstats
+import tracemalloc
+import bisect
+import itertools
+import heapq
+import zipfile
+from urllib.parse import unquote
 from docxcompose.composer import Composer
-from bs4 import BeautifulSoup
+from lxml import etree
 import ebooklib
 from ebooklib import epub
 from aiogram import Bot, Router, types, F, Dispatcher
-from aiogram.types import Message, FSInputFile, BotCommand, BotCommandScopeDefault, BotCommandScopeAllGroupChats
+from aiogram.types import Message, FSInputFile, BufferedInputFile, BotCommand, BotCommandScopeDefault, BotCommandScopeAllGroupChats
 from aiogram.filters import Command
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from aiogram.utils import markdown as md
-import aiofiles
 import asyncio
 import nest_asyncio
 import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State
 from aiogram.fsm.state import StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage
 from functools import partial
-from collections import deque
+from contextlib import contextmanager
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 nest_asyncio.apply()
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardRemove
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+# Роль процесса: "standalone" — все в одном процессе; "frontend" — только Telegram,
+# конвертацию выполняют воркеры ("worker") через общую очередь заданий (JobBroker).
+# Сколько заданий frontend держит в очереди одновременно, задает BROKER_MAX_INFLIGHT
+# (или MAX_CONCURRENT_TASKS): при 1 дополнительные воркеры ничего не ускоряют
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "standalone")
+
+# ===================== Пул для CPU-bound задач =====================
+# Бэкенд исполнителя: "process" (пул процессов, по умолчанию) или "thread" (пул потоков)
+EXECUTOR_BACKEND = os.getenv("EXECUTOR_BACKEND", "process")
+# Количество воркеров, по умолчанию — по числу ядер
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", os.cpu_count() or 1))
+
+def _warm_up_worker():
+    """Инициализатор воркера: заранее импортирует тяжелые библиотеки."""
+    import docx.oxml
+    import lxml.etree
+    import docxcompose.composer
+    import ebooklib.epub
+    import PIL.JpegImagePlugin
+    import PIL.PngImagePlugin
+    from PIL import Image
+    Image.init()
+
+def _noop():
+    return os.getpid()
+
+def create_executor(backend, max_workers):
+    """
+    Создает исполнитель для CPU-bound задач.
+    Пул процессов используется только при наличии fork, иначе — пул потоков.
+    """
+    if backend == "process":
+        if "fork" in multiprocessing.get_all_start_methods():
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_warm_up_worker,
+            )
+        print("fork недоступен, используется пул потоков")
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, initializer=_warm_up_worker)
 
-# Создаем пул потоков для выполнения CPU-bound задач
-thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+executor = create_executor(EXECUTOR_BACKEND, EXECUTOR_WORKERS)
+
+async def warm_up_executor():
+    """Запускает все воркеры пула заранее, чтобы первая задача не ждала их старта."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, _noop) for _ in range(EXECUTOR_WORKERS)))
+    print(f"Пул {type(executor).__name__} запущен: {EXECUTOR_WORKERS} воркеров")
 
 async def set_bot_commands(bot: Bot):
     commands = [
@@ -74,62 +152,173 @@ async def check_sender(message: types.Message):
     """Проверяет отправителя. Если не пользователь, отвечает и возвращает True."""
     if message.sender_chat:
         bot_message = await message.reply("Анонимные пользователи (от имени каналов/групп) не могут использовать этого бота.")
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+        deletions.schedule(bot_message, delay=5)
         return True # Да, это не пользователь, обработку надо прервать
     return False # Нет, это пользователь, можно продолжать
 
-# --- Вспомогательная функция для удаления сообщений ---
-async def delete_message_after_delay(message: types.Message, delay: int):
-    """Удаляет сообщение после указанной задержки."""
-    await asyncio.sleep(delay)
-    try:
-        await message.delete()
-    except TelegramBadRequest: # Игнорируем ошибки, если сообщение уже удалено
-        pass
-    except Exception as e:
-        print(f"Не удалось удалить сообщение {message.message_id}: {e}")
+DELETE_BATCH_SIZE = 100  # Максимум сообщений в одном deleteMessages
 
 async def del_msg(chat_id, list_delete_message):
-    # Удаляем сохранённые сообщения
-    for msg_id in list_delete_message:
-        try:
-           await bot.delete_message(chat_id, msg_id)
-           await asyncio.sleep(0.1)
-        except TelegramBadRequest: pass
-        except Exception as e: print(f"Ошибка удаления сообщения {msg_id} при end_merge: {e}")
+    # Удаляем сохранённые сообщения пачками (частоту запросов ограничивает rate_limiter)
+    with tracer.span("del_msg", messages=len(list_delete_message)):
+        for i in range(0, len(list_delete_message), DELETE_BATCH_SIZE):
+            batch = list_delete_message[i:i + DELETE_BATCH_SIZE]
+            try:
+                await bot.delete_messages(chat_id, batch)
+            except TelegramBadRequest: pass
+            except Exception as e: print(f"Ошибка удаления сообщений {batch} при end_merge: {e}")
+
+# --- Отложенное удаление сообщений ---
+DELETIONS_DB = os.getenv("DELETIONS_DB", "deletions.db")
+DELETION_BATCH_WINDOW = float(os.getenv("DELETION_BATCH_WINDOW", 1))  # Удаления в пределах окна выполняются одной пачкой
+
+class DeletionScheduler:
+    """
+    Все отложенные удаления сообщений в одной куче по времени: вместо спящей задачи
+    на каждое сообщение — одна фоновая задача, которая удаляет наступившие сообщения
+    пачками через deleteMessages. Очередь хранится в SQLite и переживает перезапуск.
+    """
+    def __init__(self, path, batch_window):
+        self.batch_window = batch_window
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS deletions (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                due REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )""")
+        self.heap = [(due, chat_id, message_id) for chat_id, message_id, due in self.db.execute("SELECT * FROM deletions")]
+        heapq.heapify(self.heap)
+        self.wakeup = asyncio.Event()
+        self.in_flight = 0  # Удаляются прямо сейчас
+        self.deleted = 0
+
+    def schedule(self, message: types.Message, delay: int):
+        """Удалит сообщение через delay секунд."""
+        self.schedule_ids(message.chat.id, [message.message_id], delay)
+
+    def schedule_ids(self, chat_id, message_ids, delay):
+        due = time.time() + delay
+        for message_id in message_ids:
+            heapq.heappush(self.heap, (due, chat_id, message_id))
+        self.db.executemany("INSERT OR REPLACE INTO deletions (chat_id, message_id, due) VALUES (?, ?, ?)",
+                            [(chat_id, message_id, due) for message_id in message_ids])
+        if self.heap[0][0] == due:
+            self.wakeup.set()  # Новое удаление раньше того, которого ждет run()
+
+    async def run(self):
+        """Фоновая задача: ждет ближайшего срока и удаляет все наступившие сообщения."""
+        while True:
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Забираем все, что наступит в пределах окна, и удаляем пачками по чатам
+            limit = time.time() + self.batch_window
+            by_chat = {}
+            while self.heap and self.heap[0][0] <= limit:
+                _, chat_id, message_id = heapq.heappop(self.heap)
+                by_chat.setdefault(chat_id, []).append(message_id)
+            self.in_flight = sum(len(ids) for ids in by_chat.values())
+            try:
+                await asyncio.gather(*(del_msg(chat_id, ids) for chat_id, ids in by_chat.items()))
+            finally:
+                self.db.executemany("DELETE FROM deletions WHERE chat_id = ? AND message_id = ?",
+                                    [(chat_id, message_id) for chat_id, ids in by_chat.items() for message_id in ids])
+                self.deleted += self.in_flight
+                self.in_flight = 0
+
+    def stats(self):
+        now = time.time()
+        return {
+            'pending': len(self.heap) + self.in_flight,
+            'overdue': sum(1 for due, _, _ in self.heap if due < now) + self.in_flight,
+            'deleted': self.deleted,
+        }
+
+# Воркер сообщения не удаляет: базу фронтенда он не открывает
+deletions = DeletionScheduler(DELETIONS_DB if PROCESS_ROLE != "worker" else ":memory:", DELETION_BATCH_WINDOW)
+
+LIMITS_DB = os.getenv("LIMITS_DB", "limits.db")  # Пустая строка — счетчики только в памяти
+LIMITS_FLUSH_INTERVAL = float(os.getenv("LIMITS_FLUSH_INTERVAL", 5))  # Секунд между записями изменений в базу
+LIMITS_LOCK_STRIPES = int(os.getenv("LIMITS_LOCK_STRIPES", 64))  # Блокировок на всех пользователей
+# Дополнительные скользящие окна "файлов/секунд" через запятую, например "10/3600,20/21600":
+# не больше 10 файлов за час и 20 за 6 часов (вдобавок к суточному лимиту со сбросом в 00:00 UTC)
+LIMITS_WINDOWS = [tuple(int(part) for part in window.split("/")) for window in os.getenv("LIMITS_WINDOWS", "").split(",") if window.strip()]
+
+def _format_period(seconds):
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600} ч."
+    return f"{seconds // 60} мин."
 
 class UserLimits:
-    def __init__(self, max_files, max_size):
-        self.user_data = {}  # {user_id: {'files_today': int}}
-        self.last_global_reset = self._get_last_utc_midnight()
-        self.user_locks = {} # Словарь для хранения блокировок пользователей
+    def __init__(self, max_files, max_size, path=None, windows=(), lock_stripes=LIMITS_LOCK_STRIPES):
+        # {user_id: [день (UTC, дней с 1970), файлов за день, [время загрузок] для окон или None]}
+        self.records = {}
+        # Блокировки по хешу user_id: число не растет с числом пользователей
+        self.user_locks = [asyncio.Lock() for _ in range(lock_stripes)]
         self.max_files = max_files
         self.max_size = max_size
         self.admins = [5787446293, 5491435817]
-        
-    def _get_last_utc_midnight(self):
-        """Возвращает последнюю полночь по UTC."""
-        now = datetime.now(timezone.utc)
-        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+        self.windows = sorted(windows, key=lambda window: window[1])
+        self.longest_window = self.windows[-1][1] if self.windows else 0
+        self.dirty = set()  # Пользователи с изменениями, еще не записанными в базу
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS limits (
+                    user_id INTEGER PRIMARY KEY,
+                    day INTEGER NOT NULL,
+                    files_today INTEGER NOT NULL,
+                    stamps TEXT
+                )""")
+            for user_id, day, files_today, stamps in self.db.execute("SELECT * FROM limits"):
+                self.records[user_id] = [day, files_today, json.loads(stamps) if stamps else None]
+            self._evict()
+
+    @staticmethod
+    def _today(now=None):
+        return int((now or time.time()) // 86400)
+
+    @property
+    def last_global_reset(self):
+        """Последняя полночь по UTC."""
+        return datetime.fromtimestamp(self._today() * 86400, timezone.utc)
+
+    def _record(self, user_id, now=None):
+        """Запись пользователя; суточный счетчик обнуляется, если запись со вчерашнего дня."""
+        day = self._today(now)
+        record = self.records.get(user_id)
+        if record is None:
+            record = self.records[user_id] = [day, 0, [] if self.windows else None]
+        elif record[0] != day:
+            record[0] = day
+            record[1] = 0
+        if self.windows and record[2] is None:
+            # Запись из базы без меток (например, окна включили после ее сохранения)
+            record[2] = []
+        return record
 
     def get_lock(self, user_id):
-        """Получает или создает блокировку для пользователя."""
-        if user_id not in self.user_locks:
-            self.user_locks[user_id] = asyncio.Lock()
-        return self.user_locks[user_id]
+        """Возвращает блокировку пользователя (общую для части пользователей)."""
+        return self.user_locks[hash(user_id) % len(self.user_locks)]
 
-    def check_limits(self, user_id, file_size):
-        """Проверяет лимиты и сбрасывает их в 00:00 UTC."""
-        now = datetime.now(timezone.utc)
+    def files_today(self, user_id):
+        return self._record(user_id)[1]
 
-        # Если наступил новый день (00:00 UTC), сбрасываем счетчики у всех
-        if now > self.last_global_reset + timedelta(days=1):
-            self.user_data.clear()  # Обнуляем данные всех пользователей
-            self.last_global_reset = self._get_last_utc_midnight()
-
-        # Инициализируем данные пользователя, если их нет
-        if user_id not in self.user_data:
-            self.user_data[user_id] = {'files_today': 0}
+    def check_limits(self, user_id, file_size):
+        """Проверяет лимиты: суточный (сброс в 00:00 UTC) и скользящие окна. Работает только с памятью."""
+        now = time.time()
+        record = self._record(user_id, now)
 
         # Проверяем лимиты
         if file_size > self.max_size * 1024 * 1024:  # Допустимый размер файла
@@ -138,33 +327,192 @@ class UserLimits:
         if user_id in self.admins:
             return True, ""
             
-        if self.user_data[user_id]['files_today'] == self.max_files:
-            time_left = (self.last_global_reset + timedelta(days=1)) - now
+        if record[1] >= self.max_files:
+            time_left = (self.last_global_reset + timedelta(days=1)) - datetime.now(timezone.utc)
             hours_left = time_left.seconds // 3600
             minutes_left = (time_left.seconds % 3600) // 60
             return False, f"❌ Лимит исчерпан ({self.max_files}/{self.max_files}). Сброс через {hours_left} ч. {minutes_left} мин. (в 00:00 UTC)."
 
+        if self.windows:
+            stamps = record[2]
+            # Старше самого длинного окна загрузки больше не нужны
+            while stamps and stamps[0] <= now - self.longest_window:
+                stamps.pop(0)
+            for count, seconds in self.windows:
+                recent = [stamp for stamp in stamps if stamp > now - seconds]
+                if len(recent) >= count:
+                    minutes_left = int((recent[-count] + seconds - now) // 60) + 1
+                    return False, f"❌ Лимит {count} файлов за {_format_period(seconds)} исчерпан. Попробуйте через {minutes_left} мин."
+
         return True, ""
+
     def increment_counter(self, user_id):
         """Увеличивает счетчик файлов пользователя."""
-        self.user_data[user_id]['files_today'] += 1
+        record = self._record(user_id)
+        record[1] += 1
+        if self.windows:
+            record[2].append(time.time())
+        self.dirty.add(user_id)
 
     def discrement_counter(self, user_id, count):
-        if user_id in self.user_data:
-            self.user_data[user_id]['files_today'] -= count
+        """Возвращает пользователю count файлов (только если они были загружены сегодня)."""
+        record = self.records.get(user_id)
+        if record is None or record[0] != self._today() or count <= 0:
+            return
+        record[1] = max(0, record[1] - count)
+        if record[2]:
+            del record[2][-count:]
+        self.dirty.add(user_id)
+
+    def _evict(self):
+        """Забывает записи, которые уже ничего не ограничивают."""
+        day = self._today()
+        deadline = time.time() - self.longest_window
+        stale = [user_id for user_id, (record_day, _, stamps) in self.records.items()
+                 if record_day != day and not (stamps and stamps[-1] > deadline)]
+        for user_id in stale:
+            del self.records[user_id]
+            self.dirty.discard(user_id)
+        if self.db and stale:
+            self.db.executemany("DELETE FROM limits WHERE user_id = ?", [(user_id,) for user_id in stale])
+
+    def flush(self):
+        """Записывает накопленные изменения одной пачкой."""
+        if self.db and self.dirty:
+            rows = []
+            for user_id in self.dirty:
+                day, files_today, stamps = self.records[user_id]
+                rows.append((user_id, day, files_today, json.dumps(stamps or [])))
+            self.db.executemany("INSERT OR REPLACE INTO limits (user_id, day, files_today, stamps) VALUES (?, ?, ?, ?)", rows)
+        self.dirty.clear()
+
+    async def run_flusher(self, interval):
+        """Фоновая запись изменений (write-behind) и удаление устаревших записей."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.flush()
+                self._evict()
+            except Exception as e:
+                print(f"Ошибка записи лимитов: {e}")
 
 # Создаем экземпляр класса лимитов
-user_limits = UserLimits(max_files=30, max_size=15)
+user_limits = UserLimits(max_files=30, max_size=15, path=LIMITS_DB if PROCESS_ROLE != "worker" else None, windows=LIMITS_WINDOWS)
 
 # Система очереди
+SCHEDULER_POLICY = os.getenv("SCHEDULER_POLICY", "fair")  # "fifo", "fair" (по кругу между пользователями) или "sjf"
+SJF_AGING_MB_PER_SEC = float(os.getenv("SJF_AGING_MB_PER_SEC", 1))  # На сколько "МБ" дешевле становится задача за секунду ожидания
+# Относительная стоимость обработки мегабайта в разных форматах
+FORMAT_COST_WEIGHTS = {".txt": 1, ".docx": 2, ".fb2": 3, ".epub": 4}
+
+def estimate_task_cost(file_list):
+    """Оценка стоимости задачи: размер файлов × вес формата."""
+    cost = 0
+    for file in file_list:
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            size = 0
+        cost += size * FORMAT_COST_WEIGHTS.get(os.path.splitext(file)[1].lower(), 1)
+    return cost
+
+class TaskScheduler:
+    """
+    Ожидающие задачи в порядке выполнения:
+    fifo — по времени добавления;
+    fair — по кругу между пользователями, задачи одного пользователя по порядку;
+    sjf  — сначала дешевые задачи (estimate_task_cost), ожидание постепенно повышает приоритет.
+    Задачи хранятся отсортированными по ключу, поэтому позиция и удаление идут через bisect,
+    а поиск — через индексы по task_id и user_id.
+    """
+    def __init__(self, policy=SCHEDULER_POLICY, aging=SJF_AGING_MB_PER_SEC * 1024 * 1024):
+        self.policy = policy
+        self.aging = aging
+        self.order = []       # [(ключ, task_id)] по возрастанию ключа
+        self.tasks = {}       # task_id -> задача
+        self.keys = {}        # task_id -> элемент order
+        self.by_user = {}     # user_id -> {task_id: задача} в порядке добавления
+        self.user_round = {}  # user_id -> круг последней задачи пользователя (fair)
+        self.round = 0        # Круг последней выданной задачи (fair)
+        self.seq = 0
+
+    def _key(self, task):
+        self.seq += 1
+        if self.policy == "fair":
+            # Новая задача пользователя попадает в следующий круг после его предыдущей задачи
+            user_id = task['user_id']
+            task_round = max(self.round, self.user_round.get(user_id, 0)) + 1
+            self.user_round[user_id] = task_round
+            return (task_round, self.seq)
+        if self.policy == "sjf":
+            # cost - aging * (now - time_added): порядок между задачами от now не зависит
+            return (task.get('cost', 0) + self.aging * task['time_added'], self.seq)
+        return (self.seq,)
+
+    def append(self, task):
+        task_id = task['task_id']
+        item = (self._key(task), task_id)
+        bisect.insort(self.order, item)
+        self.tasks[task_id] = task
+        self.keys[task_id] = item
+        self.by_user.setdefault(task['user_id'], {})[task_id] = task
+
+    def _forget(self, task):
+        task_id = task['task_id']
+        del self.tasks[task_id]
+        del self.keys[task_id]
+        user_id = task['user_id']
+        del self.by_user[user_id][task_id]
+        if not self.by_user[user_id]:
+            del self.by_user[user_id]
+            self.user_round.pop(user_id, None)
+
+    def popleft(self):
+        """Следующая задача по выбранному порядку."""
+        (key, task_id) = self.order.pop(0)
+        task = self.tasks[task_id]
+        self._forget(task)
+        if self.policy == "fair":
+            self.round = key[0]
+        return task
+
+    def pop(self, task_id):
+        """Убирает задачу из очереди. Возвращает задачу или None."""
+        item = self.keys.get(task_id)
+        if item is None:
+            return None
+        del self.order[bisect.bisect_left(self.order, item)]
+        task = self.tasks[task_id]
+        self._forget(task)
+        return task
+
+    def get(self, task_id):
+        return self.tasks.get(task_id)
+
+    def position(self, task_id):
+        """Позиция задачи в очереди (с 1) или None."""
+        item = self.keys.get(task_id)
+        if item is None:
+            return None
+        return bisect.bisect_left(self.order, item) + 1
+
+    def user_tasks(self, user_id):
+        return list(self.by_user.get(user_id, {}).values())
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return (self.tasks[task_id] for _, task_id in self.order)
+
 class TaskQueue:
     def __init__(self, max_concurrent_tasks):
-        self.queue = deque()  # Очередь задач
+        self.queue = TaskScheduler()  # Очередь задач
         self.active_tasks = {}  # Активные задачи: task_id -> task (вместо user_id -> task)
         self.max_concurrent_tasks = max_concurrent_tasks
         self.task_counter = 0  # Счетчик задач для назначения номера очереди
 
-    def add_task(self, user_id, chat_id, message_thread_id, is_forum, file_list, output_file_name):
+    def add_task(self, user_id, chat_id, message_thread_id, is_forum, file_list, output_file_name, workspace=None, trace=None):
         """Добавляет задачу в очередь и возвращает уникальный ID задачи и позицию в очереди"""
         self.task_counter += 1
         task_id = self.task_counter
@@ -175,13 +523,16 @@ class TaskQueue:
             'is_forum': is_forum,
             'file_list': file_list,
             'output_file_name': output_file_name,
+            'workspace': workspace,
+            'trace': trace,  # Контекст трассы сессии (Tracer) или None
             'task_id': task_id,
             'time_added': time.time(),
             'list_delete_message': []
         }
+        task['cost'] = estimate_task_cost(file_list)
         self.queue.append(task)
 
-        return task, len(self.queue)
+        return task, self.queue.position(task_id)
 
     def get_next_task(self):
         """Получить следующую задачу из очереди"""
@@ -189,8 +540,15 @@ class TaskQueue:
             return None
         task = self.queue.popleft()
         self.active_tasks[task['task_id']] = task  # Используем task_id вместо user_id
+        QUEUE_WAIT_SECONDS.observe(time.time() - task['time_added'])
+        tracer.record("queue", int(task['time_added'] * 1e9), time.time_ns(),
+                      {"task.id": task['task_id'], "files": len(task['file_list'])}, parent=task.get('trace'))
         return task
 
+    def cancel_task(self, task_id):
+        """Убрать ожидающую задачу из очереди. Возвращает задачу или None"""
+        return self.queue.pop(task_id)
+
     def complete_task(self, task_id):
         """Пометить задачу как завершенную"""
         if task_id in self.active_tasks:
@@ -203,15 +561,13 @@ class TaskQueue:
     def get_user_tasks(self, user_id):
         """Получить список всех задач пользователя (в очереди и активных)"""
         tasks = []
-        # Ищем в активных задачах
+        # Ищем в активных задачах (их не больше max_concurrent_tasks)
         for task_id, task in self.active_tasks.items():
             if task['user_id'] == user_id:
                 tasks.append(task)
 
-        # Ищем в очереди
-        for task in self.queue:
-            if task['user_id'] == user_id:
-                tasks.append(task)
+        # Задачи в очереди берем из индекса по пользователю
+        tasks.extend(self.queue.user_tasks(user_id))
 
         return tasks
 
@@ -219,8 +575,96 @@ class TaskQueue:
         """Проверка, можно ли обработать следующую задачу из очереди"""
         return len(self.active_tasks) < self.max_concurrent_tasks and self.queue
 
-# Создаем очередь задач
-task_queue = TaskQueue(max_concurrent_tasks=1)  # Максимум 5 одновременных задач
+class SqliteTaskQueue(TaskQueue):
+    """
+    Очередь задач, сохраняемая в SQLite (WAL): задачи переживают перезапуск бота.
+    В памяти остаются те же queue и active_tasks, база пишется при каждом изменении.
+    Задачи, которые выполнялись в момент остановки, при запуске снова ставятся в очередь.
+    """
+    # Поля задачи, которые нужны для ее выполнения после перезапуска
+    PAYLOAD_FIELDS = ('chat_id', 'message_thread_id', 'is_forum', 'file_list',
+                      'output_file_name', 'workspace', 'list_delete_message', 'trace')
+
+    def __init__(self, max_concurrent_tasks, path):
+        super().__init__(max_concurrent_tasks)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # В WAL достаточно для сохранности при падении процесса
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,  -- queued, active, done, cancelled
+                payload TEXT NOT NULL,
+                enqueued REAL NOT NULL,
+                started REAL,
+                finished REAL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, task_id)")
+        self.recovered = self._recover()
+
+    def _payload(self, task):
+        # get: у задач, сохраненных прежней версией, может не быть новых полей
+        return json.dumps({field: task.get(field) for field in self.PAYLOAD_FIELDS}, ensure_ascii=False)
+
+    def _recover(self):
+        """Загружает незавершенные задачи; прерванные перезапуском снова ставятся в очередь."""
+        self.db.execute("UPDATE tasks SET status = 'queued', started = NULL WHERE status = 'active'")
+        rows = self.db.execute(
+            "SELECT task_id, user_id, payload, enqueued FROM tasks WHERE status = 'queued' ORDER BY task_id"
+        ).fetchall()
+        for task_id, user_id, payload, enqueued in rows:
+            task = json.loads(payload)
+            task.update(user_id=user_id, task_id=task_id, time_added=enqueued)
+            task['cost'] = estimate_task_cost(task['file_list'])
+            self.queue.append(task)
+        self.task_counter = self.db.execute("SELECT COALESCE(MAX(task_id), 0) FROM tasks").fetchone()[0]
+        return len(rows)
+
+    def add_task(self, user_id, chat_id, message_thread_id, is_forum, file_list, output_file_name, workspace=None, trace=None):
+        task, position = super().add_task(user_id, chat_id, message_thread_id, is_forum, file_list, output_file_name, workspace, trace)
+        self.db.execute(
+            "INSERT INTO tasks (task_id, user_id, status, payload, enqueued) VALUES (?, ?, 'queued', ?, ?)",
+            (task['task_id'], user_id, self._payload(task), task['time_added']))
+        return task, position
+
+    def get_next_task(self):
+        task = super().get_next_task()
+        if task:
+            # Сохраняем и сообщения, добавленные к задаче после постановки в очередь
+            self.db.execute("UPDATE tasks SET status = 'active', started = ?, payload = ? WHERE task_id = ?",
+                            (time.time(), self._payload(task), task['task_id']))
+        return task
+
+    def complete_task(self, task_id):
+        super().complete_task(task_id)
+        self.db.execute("UPDATE tasks SET status = 'done', finished = ? WHERE task_id = ?", (time.time(), task_id))
+
+    def cancel_task(self, task_id):
+        task = super().cancel_task(task_id)
+        if task:
+            self.db.execute("UPDATE tasks SET status = 'cancelled', finished = ? WHERE task_id = ?", (time.time(), task_id))
+        return task
+
+    def prune(self, max_age):
+        """Удаляет записи о завершенных задачах старше max_age секунд."""
+        self.db.execute("DELETE FROM tasks WHERE status IN ('done', 'cancelled') AND finished < ?", (time.time() - max_age,))
+
+TASK_QUEUE_BACKEND = os.getenv("TASK_QUEUE_BACKEND", "sqlite")  # "sqlite" или "memory"
+TASK_QUEUE_DB = os.getenv("TASK_QUEUE_DB", "tasks.db")
+TASK_HISTORY_DAYS = int(os.getenv("TASK_HISTORY_DAYS", 7))  # Сколько хранить записи о завершенных задачах
+
+# Заданий у воркеров одновременно (режим frontend): должно быть не меньше суммы WORKER_JOBS всех воркеров
+BROKER_MAX_INFLIGHT = int(os.getenv("BROKER_MAX_INFLIGHT", 64))
+# Сколько задач выполняется одновременно; в режиме frontend задача только ждет воркера
+MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", BROKER_MAX_INFLIGHT if PROCESS_ROLE == "frontend" else 1))
+
+# Создаем очередь задач; воркер берет задания у брокера, а восстановление
+# SqliteTaskQueue переписало бы таблицу задач работающего фронтенда
+if TASK_QUEUE_BACKEND == "sqlite" and PROCESS_ROLE != "worker":
+    task_queue = SqliteTaskQueue(max_concurrent_tasks=MAX_CONCURRENT_TASKS, path=TASK_QUEUE_DB)
+else:
+    task_queue = TaskQueue(max_concurrent_tasks=MAX_CONCURRENT_TASKS)
 
 # Декоратор для измерения времени выполнения функции
 def timer(func):
@@ -232,195 +676,1628 @@ def timer(func):
         return result
     return wrapper
 
+# ===================== Метрики =====================
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # Отдельный сервер для /metrics; 0 — только /metrics вебхука
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _metric_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Гистограмма в формате Prometheus; observe можно вызывать из любого потока."""
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # значения меток -> [счетчики корзин..., сумма, количество]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    bucket = _metric_labels(self.labels, label_values, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket} {count}")
+                bucket = _metric_labels(self.labels, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket} {series[-1]}")
+                lines.append(f"{self.name}_sum{_metric_labels(self.labels, label_values)} {series[-2]}")
+                lines.append(f"{self.name}_count{_metric_labels(self.labels, label_values)} {series[-1]}")
+        return lines
+
+class Counter:
+    """Счетчик в формате Prometheus."""
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_metric_labels(self.labels, label_values)} {value}")
+        return lines
+
+class CallbackMetric:
+    """Метрика, значение которой считается при запросе /metrics (очереди, кэш, диск)."""
+    def __init__(self, name, help, func, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def collect(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"Ошибка метрики {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, func):
+        return self.register(CallbackMetric(name, help, func))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+DOWNLOAD_SECONDS = metrics.register(Histogram("bot_download_seconds", "Загрузка файла из Telegram"))
+CONVERT_SECONDS = metrics.register(Histogram("bot_convert_seconds", "Конвертация файла (без кэша)", ("format",)))
+IMAGE_SECONDS = metrics.register(Histogram("bot_image_seconds", "Перекодирование изображений файла (сумма по потокам)", ("format",)))
+TITLE_SECONDS = metrics.register(Histogram("bot_title_detection_seconds", "Поиск и добавление заголовка при объединении"))
+MERGE_SECONDS = metrics.register(Histogram("bot_merge_seconds", "Объединение файлов задачи", ("mode",)))
+UPLOAD_SECONDS = metrics.register(Histogram("bot_upload_seconds", "Отправка итогового файла в Telegram"))
+QUEUE_WAIT_SECONDS = metrics.register(Histogram("bot_queue_wait_seconds", "Ожидание задачи в очереди"))
+CONVERSION_ERRORS = metrics.register(Counter("bot_conversion_errors_total", "Ошибки конвертации", ("format",)))
+
+# ===================== Трассировка =====================
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # Спаны в формате OTLP JSON, по строке на пачку
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))  # Доля трассируемых сессий (0 — трассировка выключена)
+TRACE_MAX_PER_MINUTE = int(os.getenv("TRACE_MAX_PER_MINUTE", 60))  # Не больше трасс в минуту при нагрузке; 0 — без ограничения
+TRACE_BATCH_SIZE = 256  # Спанов в буфере до записи в файл
+
+# Текущий спан: {'trace_id', 'span_id'} или None, если сессия не попала в выборку
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+class Tracer:
+    """
+    Трассировка сессии сбора от /start_merge до отправки результата.
+    Решение о выборке принимается один раз на сессию (start_trace); для сессии вне выборки
+    контекст равен None, и span() ничего не записывает. Контекст трассы хранится в данных FSM
+    и в задаче, а внутри задачи передается через contextvars (current_span).
+    Спаны пишутся в файл в формате OTLP JSON (как у файлового экспортера OpenTelemetry Collector).
+    """
+    def __init__(self, path, sample_rate, max_per_minute):
+        self.path = path
+        self.sample_rate = sample_rate if path else 0
+        self.max_per_minute = max_per_minute
+        self.window_start = 0.0
+        self.window_traces = 0
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.traces = 0
+        self.spans = 0
+
+    def start_trace(self, name, **attributes):
+        """Начинает трассу сессии; возвращает контекст (сохраняемый в JSON) или None."""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        now = time.time()
+        if now - self.window_start >= 60:
+            self.window_start, self.window_traces = now, 0
+        if self.max_per_minute and self.window_traces >= self.max_per_minute:
+            return None
+        self.window_traces += 1
+        self.traces += 1
+        return {'trace_id': os.urandom(16).hex(), 'span_id': os.urandom(8).hex(),
+                'name': name, 'start': time.time_ns(), 'attributes': attributes}
+
+    def end_trace(self, trace, error=None, **attributes):
+        """Записывает корневой спан сессии и сбрасывает буфер в файл."""
+        if trace is None:
+            return
+        self._add(trace['trace_id'], trace['span_id'], None, trace['name'], trace['start'], time.time_ns(),
+                  {**trace['attributes'], **attributes}, error)
+        self.flush()
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        """
+        Спан вокруг блока кода. Родитель — parent или текущий спан; атрибуты можно дополнять
+        через возвращаемый словарь. Исключение отмечается в статусе спана и пробрасывается дальше.
+        """
+        parent = parent or current_span.get()
+        if parent is None:
+            yield attributes
+            return
+        context = {'trace_id': parent['trace_id'], 'span_id': os.urandom(8).hex()}
+        token = current_span.set(context)
+        start = time.time_ns()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span.reset(token)
+            self._add(context['trace_id'], context['span_id'], parent['span_id'], name, start, time.time_ns(), attributes, error)
+
+    def record(self, name, start, end, attributes=None, parent=None, error=None):
+        """Спан по уже измеренным времени начала и конца (нс), например из процесса пула."""
+        parent = parent or current_span.get()
+        if parent is not None:
+            self._add(parent['trace_id'], os.urandom(8).hex(), parent['span_id'], name, start, end, attributes or {}, error)
+
+    def _add(self, trace_id, span_id, parent_id, name, start, end, attributes, error):
+        span = {
+            "traceId": trace_id,
+            "spanId": span_id,
+            "name": name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(end),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None],
+        }
+        if parent_id:
+            span["parentSpanId"] = parent_id
+        if error:
+            span["status"] = {"code": 2, "message": error}  # STATUS_CODE_ERROR
+        with self.lock:
+            self.buffer.append(span)
+            self.spans += 1
+            full = len(self.buffer) >= TRACE_BATCH_SIZE
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            spans, self.buffer = self.buffer, []
+        if not spans:
+            return
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "merge-bot"}},
+                                        {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]},
+            "scopeSpans": [{"scope": {"name": "bot"}, "spans": spans}],
+        }]}, ensure_ascii=False)
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Не удалось записать трассы в {self.path}: {e}")
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_MAX_PER_MINUTE)
+
+# ===================== Ограничение исходящих запросов =====================
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))  # Запросов в секунду на весь бот
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # Сообщений в секунду в личный чат
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60))  # Сообщений в секунду в группу
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 3))  # Сообщений подряд в чат без ожидания
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))  # Повторов после ответа 429
+# Методы, которые Telegram ограничивает по чату
+RATE_LIMITED_CHAT_METHODS = {"SendMessage", "SendDocument", "SendPhoto", "EditMessageText", "CopyMessage", "ForwardMessage"}
+
+class TokenBucket:
+    """
+    Корзина токенов с резервированием: токены могут уйти в минус, и каждый вызов
+    получает свое время ожидания, поэтому запросы выполняются в порядке обращения.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Берет токен и возвращает, сколько секунд нужно подождать."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class RateLimiter(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: все исходящие запросы проходят общую корзину токенов,
+    а отправка сообщений — еще и корзину своего чата. Ответ 429 (retry_after)
+    приостанавливает все запросы на указанное время, после чего запрос повторяется.
+    """
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst, max_retries):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}  # chat_id -> TokenBucket
+        self.paused_until = 0.0
+        self.waiting = 0        # Запросов ждут своей очереди сейчас
+        self.max_waiting = 0
+        self.requests = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+        self.retry_after_hits = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Полные корзины ничего не ограничивают — их можно забыть
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle()}
+            rate = self.group_rate if isinstance(chat_id, str) or chat_id < 0 else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, max(self.chat_burst, rate))
+        return bucket
+
+    async def _acquire(self, chat_id):
+        delay = 0.0
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+            delay += pause
+        global_delay = self.global_bucket.reserve()
+        if global_delay:
+            await asyncio.sleep(global_delay)
+            delay += global_delay
+        if delay:
+            self.delayed += 1
+            self.wait_seconds += delay
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None) if type(method).__name__ in RATE_LIMITED_CHAT_METHODS else None
+        for attempt in range(self.max_retries + 1):
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                await self._acquire(chat_id)
+            finally:
+                self.waiting -= 1
+            self.requests += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_hits += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                print(f"Telegram просит подождать {e.retry_after} с ({type(method).__name__})")
+                if attempt == self.max_retries:
+                    raise
+
+    def stats(self):
+        return {
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'requests': self.requests,
+            'delayed': self.delayed,
+            'wait_seconds': self.wait_seconds,
+            'retry_after': self.retry_after_hits,
+            'chats': len(self.chat_buckets),
+        }
+
+rate_limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES)
+
 # Замените токен на свой
 API_TOKEN = os.getenv("API_TOKEN") 
-bot = Bot(token=API_TOKEN)
+BOT_API_SERVER = os.getenv("BOT_API_SERVER")  # Свой сервер Bot API (локальный или тестовый), например http://localhost:8081
+
+def create_bot():
+    session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_SERVER)) if BOT_API_SERVER else AiohttpSession()
+    session.middleware(rate_limiter)
+    return Bot(token=API_TOKEN, session=session)
+
+# Воркерам токен не нужен: они не обращаются к Telegram
+bot = create_bot() if API_TOKEN else None
 router = Router()
 
 # ===================== Неблокирующие функции конвертации =====================
 
-# Функция-обертка для выполнения блокирующих операций в отдельном потоке
-async def run_in_threadpool(func, *args, **kwargs):
+# Функция-обертка для выполнения блокирующих операций в пуле.
+# Для пула процессов func должна быть функцией модуля, а аргументы — простыми (пути к файлам)
+executor_busy = 0  # Вызовов в пуле сейчас (выполняются или ждут свободного воркера)
+
+def _replace_broken_executor(broken):
+    """
+    Пересоздает пул после гибели воркера (OOM, падение в lxml или PIL): сломанный
+    ProcessPoolExecutor больше не принимает задачи. Пул, уже замененный другим вызовом, не трогаем.
+    """
+    global executor
+    if executor is broken:
+        print("Воркер пула аварийно завершился, пул пересоздается")
+        executor = create_executor(EXECUTOR_BACKEND, EXECUTOR_WORKERS)
+        broken.shutdown(wait=False, cancel_futures=True)
+
+async def run_in_executor(func, *args, **kwargs):
+    global executor_busy
     loop = asyncio.get_running_loop()
     func_partial = partial(func, *args, **kwargs)
-    return await loop.run_in_executor(thread_pool, func_partial)
+    executor_busy += 1
+    try:
+        # Один повтор на новом пуле: если воркер убил сам этот вызов, ошибка достанется только ему
+        for attempt in range(2):
+            current = executor
+            try:
+                return await loop.run_in_executor(current, func_partial)
+            except concurrent.futures.process.BrokenProcessPool:
+                _replace_broken_executor(current)
+                if attempt:
+                    raise
+    finally:
+        executor_busy -= 1
+
+# ===================== Профилирование задач =====================
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 30))  # Строк в сводках cProfile и tracemalloc
+PROFILE_TRACEBACK = 10  # Глубина стека tracemalloc для мест выделения памяти
+PROFILE_SUFFIX = ".profile.txt"  # Сводка воркера рядом с итоговым файлом задания
 
-# Неблокирующие версии функций конвертации
-async def convert_epub_to_docx(epub_file, docx_file):
-    def _convert():
+def _profiled_call(func, *args):
+    """
+    Выполняется в воркере: вызывает func под cProfile и tracemalloc.
+    Возвращает (результат, время, текст сводки). cProfile видит только поток воркера,
+    перекодирование изображений на пуле потоков попадает в сводку как ожидание.
+    """
+    profiler = cProfile.Profile()
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(PROFILE_TRACEBACK)
+    start_time = time.perf_counter()
+    profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start_time
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    lines = [f"Память: сейчас {current / 1024 / 1024:.1f} МБ, пик {peak / 1024 / 1024:.1f} МБ",
+             f"Топ-{PROFILE_TOP} мест выделения памяти, не освобожденной к концу вызова:"]
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+        lines.append(f"  {stat.size / 1024:10.1f} КБ {stat.count:8d} блоков  {stat.traceback}")
+    lines.append("")
+    lines.append(stream.getvalue())
+    return result, elapsed, "\n".join(lines)
+
+# Сводка задачи, которую сейчас профилируем (ProfileReport), или None
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+class ProfileReport:
+    """Сводки профилирования одной задачи: по разделу на каждый вызов в пуле."""
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.started = time.time()
+        self.sections = []  # (заголовок, время в секундах или None, текст)
+
+    async def call(self, title, func, *args):
+        """Выполняет func в пуле под профилировщиком и добавляет раздел сводки."""
+        result, elapsed, summary = await run_in_executor(_profiled_call, func, *args)
+        self.sections.append((title, elapsed, summary))
+        return result
+
+    def add(self, title, text, elapsed=None):
+        self.sections.append((title, elapsed, text))
+
+    def render(self, elapsed=None):
+        lines = [f"Профиль задачи #{self.task_id}"]
+        if elapsed is not None:
+            lines.append(f"Время выполнения: {elapsed:.2f} секунд")
+        lines.append("Файлы, сконвертированные заранее или взятые из кэша, в сводку не попадают.")
+        for title, seconds, text in self.sections:
+            lines.append("")
+            lines.append("=" * 20 + f" {title}" + (f" ({seconds:.2f} с)" if seconds is not None else "") + " " + "=" * 20)
+            lines.append(text)
+        return "\n".join(lines)
+
+class TaskProfiler:
+    """
+    Профилирование задач по команде администратора /profile.
+    Выключенный профилировщик стоит одной проверки на задачу: без сводки (current_profile = None)
+    конвертация и объединение идут обычным путем.
+    """
+    def __init__(self):
+        self.remaining = 0    # Сколько сводок еще отправить (0 — выключено)
+        self.threshold = 0.0  # Отправлять сводки только задач дольше threshold секунд
+        self.chat_id = None   # Куда отправлять сводки
+        self.delivered = 0
+
+    def arm(self, count, threshold, chat_id):
+        self.remaining = count
+        self.threshold = threshold
+        self.chat_id = chat_id
+
+    def disarm(self):
+        self.remaining = 0
+
+    def take(self, task_id):
+        """Сводка для начинающейся задачи или None, если профилирование выключено."""
+        if self.remaining <= 0:
+            return None
+        if not self.threshold:
+            self.remaining -= 1  # Без порога сводка отправляется каждой задаче
+        return ProfileReport(task_id)
+
+    def should_deliver(self, elapsed):
+        """Решает по длительности задачи, отправлять ли сводку."""
+        if not self.threshold:
+            return True
+        if elapsed < self.threshold or self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    async def deliver(self, report, elapsed):
+        """Отправляет сводку документом в чат администратора."""
+        if self.chat_id is None or not self.should_deliver(elapsed):
+            return
+        document = BufferedInputFile(report.render(elapsed).encode("utf-8"), filename=f"profile_task_{report.task_id}.txt")
+        await bot.send_document(self.chat_id, document=document, caption=f"Профиль задачи #{report.task_id}: {elapsed:.1f} с")
+        self.delivered += 1
+
+task_profiler = TaskProfiler()
+
+# ===================== Изображения =====================
+IMAGE_WIDTH = Inches(5.5)  # Ширина изображений в документе
+IMAGE_DPI = int(os.getenv("IMAGE_DPI", 150))  # Изображения уменьшаются до этой плотности при ширине IMAGE_WIDTH
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 70))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))  # Потоков перекодирования на один процесс-конвертер
+IMAGE_MEMO_SIZE = 256  # Сколько перекодированных изображений помнит процесс
+IMAGE_MEMO_MAX_MB = int(os.getenv("IMAGE_MEMO_MAX_MB", 32))  # И не больше этого объема
+
+_image_pool = None
+_image_pool_pid = None
+_image_memo = OrderedDict()  # sha1 исходника -> перекодированные байты
+_image_memo_bytes = 0
+_image_seconds = 0.0  # Время перекодирования изображений в этом процессе (для метрик)
+_images_added = 0  # Изображений, вставленных в модели в этом процессе (для трассировки)
+_image_memo_lock = threading.Lock()
+
+def image_pool():
+    """Пул перекодирования изображений, свой в каждом процессе (после fork пул родителя непригоден)."""
+    global _image_pool, _image_pool_pid
+    if _image_pool_pid != os.getpid():
+        _image_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+        _image_pool_pid = os.getpid()
+    return _image_pool
+
+def transcode_image(data):
+    """
+    Готовит изображение для вставки в DOCX: уменьшает до IMAGE_DPI при ширине IMAGE_WIDTH
+    (большие JPEG декодируются сразу в уменьшенном виде через draft) и кодирует в JPEG.
+    Для изображений с прозрачностью и малым числом цветов оставляет PNG, если он меньше.
+    """
+    target_width = int(IMAGE_WIDTH.inches * IMAGE_DPI)
+    img = Image.open(io.BytesIO(data))
+    if img.format == 'JPEG' and img.width > target_width * 2:
+        img.draft('RGB', (target_width, max(1, img.height * target_width // img.width)))
+    img.load()
+    if img.width > target_width:
+        img = img.resize((target_width, max(1, round(img.height * target_width / img.width))), Image.LANCZOS)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+    if has_alpha:
+        img = img.convert('RGBA')
+        rgb = Image.new('RGB', img.size, (255, 255, 255))
+        rgb.paste(img, mask=img.getchannel('A'))  # Прозрачный фон -> белый, а не черный
+    else:
+        rgb = img.convert('RGB')
+    jpeg = io.BytesIO()
+    rgb.save(jpeg, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    result = jpeg.getvalue()
+
+    # Штриховая графика с прозрачностью (орнаменты, разделители) в PNG обычно меньше и четче
+    if has_alpha and img.getcolors(256) is not None:
+        png = io.BytesIO()
+        img.quantize(256).save(png, format='PNG', optimize=True)
+        if png.tell() < len(result):
+            result = png.getvalue()
+    return result
+
+def clear_image_memo():
+    global _image_memo_bytes
+    with _image_memo_lock:
+        _image_memo.clear()
+        _image_memo_bytes = 0
+
+def _transcode_memoized(key, data):
+    global _image_seconds, _image_memo_bytes
+    with _image_memo_lock:
+        if key in _image_memo:
+            _image_memo.move_to_end(key)
+            return _image_memo[key]
+    start_time = time.perf_counter()
+    result = transcode_image(data)
+    with _image_memo_lock:
+        _image_seconds += time.perf_counter() - start_time
+        if key not in _image_memo:
+            _image_memo[key] = result
+            _image_memo_bytes += len(result)
+        while _image_memo and (len(_image_memo) > IMAGE_MEMO_SIZE or _image_memo_bytes > IMAGE_MEMO_MAX_MB * 1024 * 1024):
+            _image_memo_bytes -= len(_image_memo.popitem(last=False)[1])
+    return result
+
+class ImageStage:
+    """
+    Перекодирование изображений одного документа на отдельном ограниченном пуле потоков.
+    Конвертер оставляет в абзаце место под изображение (DocModel.add_slot) и продолжает разбор,
+    а изображения вставляются в finish(). Одинаковые изображения (по sha1) перекодируются один раз.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix  # Префикс для сообщений об ошибках: "FB2", "EPUB"
+        self.futures = {}  # sha1 -> Future с перекодированными байтами
+        self.placements = []  # (место под изображение, Future, метка)
+
+    def add(self, slot, data, label):
+        key = hashlib.sha1(data).digest()
+        future = self.futures.get(key)
+        if future is None:
+            future = image_pool().submit(_transcode_memoized, key, data)
+            self.futures[key] = future
+        self.placements.append((slot, future, label))
+
+    def finish(self):
+        """Дожидается перекодирования и вставляет изображения на их места. Возвращает их число."""
+        global _images_added
+        added = 0
+        for (runs, index), future, label in self.placements:
+            try:
+                runs[index] = future.result()
+                added += 1
+            except Exception as img_e:
+                print(f"{self.prefix}: Ошибка добавления изображения '{label}' в DOCX: {img_e}")
+                runs[index] = (f"[Ошибка добавления изображения: {label}]", ())
+        self.placements.clear()
+        _images_added += added
+        return added
+
+# ===================== HTML -> DOCX =====================
+W_R = qn('w:r')
+W_T = qn('w:t')
+W_RPR = qn('w:rPr')
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+# Форматирование run'а в порядке, требуемом схемой w:rPr
+RUN_FORMATS = {
+    'bold': ('w:b', None),
+    'italic': ('w:i', None),
+    'strike': ('w:strike', None),
+    'underline': ('w:u', 'single'),
+    'superscript': ('w:vertAlign', 'superscript'),
+    'subscript': ('w:vertAlign', 'subscript'),
+}
+RUN_FORMAT_ORDER = list(RUN_FORMATS)
+
+class BodyWriter:
+    """
+    Быстрая запись абзацев в конец тела документа.
+    document.add_paragraph каждый раз ищет sectPr среди всех абзацев тела, а Run.text
+    разбирает текст по символам, поэтому на длинных документах python-docx очень медленный.
+    Здесь абзацы вставляются перед sectPr за O(1), а run'ы собираются сразу из lxml-элементов.
+    """
+    def __init__(self, document):
+        self.document = document
+        self.body = document.element.body
+        self.sectPr = self.body.sectPr  # Последний элемент тела, новые абзацы вставляются перед ним
+        self.style_ids = {}
+
+    def style_id(self, style):
+        """id стиля по имени; None, если такого стиля в документе нет."""
+        if style not in self.style_ids:
+            try:
+                self.style_ids[style] = self.document.styles[style].style_id
+            except KeyError:
+                self.style_ids[style] = None
+        return self.style_ids[style]
+
+    def add_paragraph(self, style=None):
+        """Добавляет пустой абзац и возвращает его lxml-элемент w:p."""
+        p = OxmlElement('w:p')
+        style_id = self.style_id(style) if style is not None else None
+        if style_id is not None:
+            p.style = style_id
+        self._append(p)
+        return p
+
+    def _append(self, p):
+        if self.sectPr is not None:
+            self.sectPr.addprevious(p)
+        else:
+            self.body.append(p)
+
+    @staticmethod
+    def add_run(p, text, formats=()):
+        """Добавляет в абзац run с текстом и форматированием ('bold', 'italic', ...)."""
+        r = etree.SubElement(p, W_R)
+        if formats:
+            rPr = etree.SubElement(r, W_RPR)
+            for fmt in sorted(set(formats), key=RUN_FORMAT_ORDER.index):
+                tag, val = RUN_FORMATS[fmt]
+                element = etree.SubElement(rPr, qn(tag))
+                if val is not None:
+                    element.set(qn('w:val'), val)
+        if '\t' in text or '\n' in text:
+            r.text = text  # Табуляции и переводы строк разбирает python-docx
+        elif text:
+            t = etree.SubElement(r, W_T)
+            t.text = text
+            if text[0] == ' ' or text[-1] == ' ':
+                t.set(XML_SPACE, 'preserve')
+        return r
+
+    def paragraph(self, p):
+        """Объект python-docx для абзаца, например для add_picture."""
+        return Paragraph(p, self.document._body)
+
+    def insert_xml(self, paragraphs_xml):
+        """Разбирает XML пачки абзацев одним вызовом и добавляет их в конец тела."""
+        if not paragraphs_xml:
+            return
+        fragment = parse_xml(f'<w:body {nsdecls("w")}>{"".join(paragraphs_xml)}</w:body>')
+        for p in list(fragment):
+            self._append(p)
+
+# Символы, недопустимые в XML 1.0 (python-docx на них падает)
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# Переводы строк и табуляции внутри run'а, как их понимает python-docx
+RUN_SPECIAL_CHARS = re.compile('(\r\n|[\r\n\t])')
+
+def _run_xml(text, formats):
+    rPr = ''
+    if formats:
+        props = []
+        for fmt in sorted(set(formats), key=RUN_FORMAT_ORDER.index):
+            tag, val = RUN_FORMATS[fmt]
+            props.append(f'<{tag}/>' if val is None else f'<{tag} w:val="{val}"/>')
+        rPr = f'<w:rPr>{"".join(props)}</w:rPr>'
+    content = []
+    for part in RUN_SPECIAL_CHARS.split(INVALID_XML_CHARS.sub('', text)):
+        if part == '\t':
+            content.append('<w:tab/>')
+        elif part in ('\n', '\r', '\r\n'):
+            content.append('<w:br/>')
+        elif part:
+            content.append(f'<w:t xml:space="preserve">{xml_escape(part)}</w:t>')
+    return f'<w:r>{rPr}{"".join(content)}</w:r>'
+
+def _paragraph_xml(style_id, runs):
+    """XML абзаца без изображений: то же, что дают add_paragraph/add_run в python-docx."""
+    pPr = f'<w:pPr><w:pStyle w:val="{style_id}"/></w:pPr>' if style_id else ''
+    runs_xml = ''.join(_run_xml(text, formats) for text, formats in runs)
+    if not pPr and not runs_xml:
+        return '<w:p/>'
+    return f'<w:p>{pPr}{runs_xml}</w:p>'
+
+# ===================== Промежуточная модель документа =====================
+class DocModel:
+    """
+    Промежуточное представление сконвертированного файла, без python-docx.
+    Абзац — список [стиль, runs], где стиль — имя стиля python-docx или None (Normal),
+    а run — кортеж (текст, форматы), байты перекодированного изображения
+    или None (место под изображение, которое заполнит ImageStage).
+    Модель передается между процессами через pickle (dumps/loads) и выводится в итоговый документ
+    один раз (render_model), без промежуточного .docx на каждый файл.
+    """
+    def __init__(self, name):
+        self.name = name  # Путь к исходному файлу, из него строится заголовок (в pickle не входит)
+        self.paragraphs = []
+        self.ok = True  # False, если конвертация завершилась ошибкой
+
+    def add_paragraph(self, style=None, text=None):
+        p = [style, []]
+        if text:
+            p[1].append((text, ()))
+        self.paragraphs.append(p)
+        return p
+
+    @staticmethod
+    def add_run(p, text, formats=()):
+        p[1].append((text, tuple(formats)))
+
+    @staticmethod
+    def add_slot(p):
+        """Оставляет в абзаце место под изображение; возвращает его адрес для ImageStage."""
+        p[1].append(None)
+        return p[1], len(p[1]) - 1
+
+    def add_plain_paragraphs(self, lines):
+        """Абзацы простого текста, как document.add_paragraph(line) для каждой строки."""
+        self.paragraphs.extend([None, [(line, ())] if line else []] for line in lines)
+
+    @staticmethod
+    def text(p):
+        return ''.join(run[0] for run in p[1] if isinstance(run, tuple))
+
+    def error(self, message):
+        self.add_paragraph(text=message)
+        self.ok = False
+
+    def dumps(self):
+        """
+        Сериализует модель только встроенными типами, чтобы pickle не зависел от модуля класса.
+        Имя не сохраняется: запись кэша общая для одинакового содержимого под любыми именами,
+        а имя передается отдельно в loads.
+        """
+        return pickle.dumps((self.ok, self.paragraphs), protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, blob, name):
+        model = cls.__new__(cls)
+        model.name = name
+        model.ok, model.paragraphs = pickle.loads(blob)
+        return model
+
+    def save(self, docx_file):
         document = Document()
+        render_model(self, document)
+        document.save(docx_file)
+
+def render_model(model, document, batch_size=2000):
+    """
+    Выводит модель в документ python-docx. Абзацы без изображений собираются в XML
+    пачками по batch_size, абзацы с изображениями добавляются через python-docx.
+    """
+    writer = BodyWriter(document)
+    batch = []
+    for style, runs in model.paragraphs:
+        if any(isinstance(run, bytes) for run in runs):
+            writer.insert_xml(batch)
+            batch = []
+            p = writer.add_paragraph(style)
+            for run in runs:
+                if isinstance(run, bytes):
+                    try:
+                        writer.paragraph(p).add_run().add_picture(io.BytesIO(run), width=IMAGE_WIDTH)
+                    except Exception as img_e:
+                        print(f"Ошибка добавления изображения в DOCX: {img_e}")
+                        writer.add_run(p, "[Ошибка добавления изображения]")
+                elif run is not None:
+                    writer.add_run(p, run[0], run[1])
+        else:
+            batch.append(_paragraph_xml(writer.style_id(style) if style else None,
+                                        [run for run in runs if run is not None]))
+            if len(batch) >= batch_size:
+                writer.insert_xml(batch)
+                batch = []
+    writer.insert_xml(batch)
+
+class HtmlDocxEmitter:
+    """
+    Однопроходный перевод HTML в DOCX.
+    Каждый элемент посещается один раз: блочные теги обрабатываются по таблице HANDLERS,
+    строчное форматирование накапливается по таблице INLINE_FORMATS.
+    Используется для EPUB и может использоваться для любого другого HTML.
+    """
+    INLINE_FORMATS = {
+        'strong': 'bold', 'b': 'bold',
+        'em': 'italic', 'i': 'italic', 'cite': 'italic', 'dfn': 'italic', 'var': 'italic',
+        'u': 'underline', 'ins': 'underline',
+        's': 'strike', 'strike': 'strike', 'del': 'strike',
+        'sup': 'superscript', 'sub': 'subscript',
+    }
+    # Контейнеры, которые разрывают абзац, но сами абзац не создают
+    BLOCK_CONTAINERS = {
+        'html', 'body', 'div', 'section', 'article', 'aside', 'header', 'footer', 'main', 'nav',
+        'blockquote', 'figure', 'figcaption', 'center', 'table', 'thead', 'tbody', 'tfoot', 'tr',
+        'td', 'th', 'dl', 'dt', 'dd', 'address', 'hgroup', 'details', 'summary',
+    }
+    SKIP_TAGS = {'head', 'script', 'style', 'noscript', 'template', 'math'}
+    HANDLERS = {
+        'p': '_emit_paragraph',
+        'h1': '_emit_heading', 'h2': '_emit_heading', 'h3': '_emit_heading',
+        'h4': '_emit_heading', 'h5': '_emit_heading', 'h6': '_emit_heading',
+        'ul': '_emit_list', 'ol': '_emit_list', 'li': '_emit_list_item',
+        'br': '_emit_break', 'img': '_emit_image', 'svg': '_emit_svg',
+        'hr': '_emit_rule', 'pre': '_emit_pre',
+    }
+    WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self, model, open_image=None, images=None):
+        """
+        model — DocModel, в который выводится текст.
+        open_image(src) возвращает (поток, метка) изображения или (None, метка), если его нет.
+        images — ImageStage, общий для всех HTML-частей документа.
+        """
+        self.model = model
+        self.open_image = open_image
+        self.images = images if images is not None else ImageStage("HTML")
+        # Таблица тег -> связанный метод собирается один раз на документ
+        self.handlers = {tag: getattr(self, name) for tag, name in self.HANDLERS.items()}
+        self.paragraph = None
+        self.has_runs = False  # Есть ли в текущем абзаце текст (для обрезки пробелов)
+        self.formats = ()
+        self.lists = []  # Стек типов открытых списков: 'ul' / 'ol'
+        self.item_style = None  # Стиль пункта списка для первого абзаца внутри <li>
+
+    # --- Разбор ---
+    @staticmethod
+    def parse(content):
+        """Разбирает HTML/XHTML через lxml. Кодировка берется из XML-декларации, по умолчанию UTF-8."""
+        if isinstance(content, bytes):
+            match = re.match(rb'\s*<\?xml[^>]*encoding=["\']([A-Za-z0-9._-]+)', content)
+            encoding = match.group(1).decode('ascii') if match else 'utf-8'
+            parser = etree.HTMLParser(encoding=encoding, remove_comments=True, remove_pis=True)
+        else:
+            parser = etree.HTMLParser(remove_comments=True, remove_pis=True)
+        return etree.fromstring(content, parser)
+
+    def emit_html(self, content):
+        root = self.parse(content)
+        if root is None:
+            return
+        body = root.find('body')
+        self._walk(body if body is not None else root)
+        self._close_paragraph()
+
+    def finish(self):
+        """Вставляет изображения; вызывается после всех emit_html."""
+        return self.images.finish()
+
+    # --- Обход ---
+    def _walk(self, element):
+        self._text(element.text)
+        for child in element:
+            tag = child.tag
+            if isinstance(tag, str):
+                tag = tag.rpartition('}')[2].lower()
+                handler = self.handlers.get(tag)
+                if handler is not None:
+                    handler(child, tag)
+                elif tag in self.INLINE_FORMATS:
+                    saved = self.formats
+                    self.formats = saved + (self.INLINE_FORMATS[tag],)
+                    self._walk(child)
+                    self.formats = saved
+                elif tag in self.BLOCK_CONTAINERS:
+                    self._close_paragraph()
+                    self._walk(child)
+                    self._close_paragraph()
+                elif tag not in self.SKIP_TAGS:
+                    # span, a, font и прочие строчные теги
+                    self._walk(child)
+            self._text(child.tail)
+
+    def _text(self, text):
+        if not text:
+            return
+        text = self.WHITESPACE.sub(' ', text)
+        if self.paragraph is None or not self.has_runs:
+            text = text.lstrip()
+            if not text:
+                return
+        if self.paragraph is None:
+            self._open_paragraph()
+        self._add_run(text)
+
+    def _add_run(self, text):
+        self.model.add_run(self.paragraph, text, self.formats)
+        self.has_runs = True
+
+    def _open_paragraph(self, style=None):
+        self._close_paragraph()
+        if style is None and self.item_style is not None:
+            # Первый абзац пункта списка: <li>текст</li> или <li><p>текст</p></li>
+            style, self.item_style = self.item_style, None
+        self.paragraph = self.model.add_paragraph(style)
+        self.has_runs = False
+        return self.paragraph
+
+    def _close_paragraph(self):
+        if self.has_runs:
+            runs = self.paragraph[1]
+            text, formats = runs[-1]
+            if text.endswith(' '):
+                runs[-1] = (text.rstrip(' '), formats)
+        self.paragraph = None
+        self.has_runs = False
+
+    # --- Обработчики блочных тегов ---
+    def _emit_paragraph(self, element, tag, style=None):
+        self._open_paragraph(style)
+        self._walk(element)
+        self._close_paragraph()
+
+    def _emit_heading(self, element, tag):
+        self._emit_paragraph(element, tag, style=f'Heading {tag[1]}')
+
+    def _emit_list(self, element, tag):
+        self._close_paragraph()
+        self.lists.append(tag)
+        self._walk(element)
+        self.lists.pop()
+        self._close_paragraph()
+
+    def _emit_list_item(self, element, tag):
+        kind = 'List Number' if self.lists and self.lists[-1] == 'ol' else 'List Bullet'
+        level = min(len(self.lists), 3)
+        # Абзац открывается только с первым текстом пункта, в том числе внутри вложенного <p>
+        self._close_paragraph()
+        saved = self.item_style
+        self.item_style = kind if level <= 1 else f'{kind} {level}'
+        self._walk(element)
+        self._close_paragraph()
+        self.item_style = saved
+
+    def _emit_break(self, element, tag):
+        if self.paragraph is not None:
+            self.model.add_run(self.paragraph, '\n')
+            self.has_runs = False
+
+    def _emit_rule(self, element, tag):
+        self._close_paragraph()
+
+    def _emit_pre(self, element, tag):
+        self._open_paragraph()
+        text = ''.join(element.itertext())
+        if text:
+            self._add_run(text.strip('\n'))
+        self._close_paragraph()
+
+    def _emit_svg(self, element, tag):
+        # Из SVG берем только растровые <image> (частая обертка обложки), остальное пропускаем
+        for image in element.iter('{*}image', 'image'):
+            self._emit_image(image, 'image')
+
+    def _emit_image(self, element, tag):
+        src = element.get('src') or next((v for k, v in element.attrib.items() if k.endswith('href')), None)
+        if not src or self.open_image is None:
+            return
+        image_stream, label = self.open_image(src)
+        if image_stream is None:
+            return
+        if self.paragraph is None:
+            self._open_paragraph()
         try:
-            # Открываем EPUB-файл
-            book = epub.read_epub(epub_file)
-            spine_ids = [item[0] for item in book.spine]  # [ 'titlepage', 'Section0001.html', ... ]
-            # Перебираем элементы книги
-            for id_ in spine_ids:
-                item = book.get_item_with_id(id_)
-                if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                    soup = BeautifulSoup(item.content, 'html.parser')
-                    html_base_path = posixpath.dirname(item.get_name())
-                    for element in soup.find_all():
-                        if element.name == 'h1':
-                            document.add_heading(element.get_text(), level=1)
-                        elif element.name == 'p':
-                            doc_paragraph = document.add_paragraph()
-                            # Перебор вложенных элементов абзаца
-                            for sub in element.contents:
-                                if hasattr(sub, 'name'):
-                                    if sub.name == 'strong':
-                                        run = doc_paragraph.add_run(sub.get_text())
-                                        run.bold = True
-                                    elif sub.name == 'em':
-                                        run = doc_paragraph.add_run(sub.get_text())
-                                        run.italic = True
-                                    else:
-                                        doc_paragraph.add_run(sub.get_text())
-                                else:
-                                    # Если это просто текст
-                                    doc_paragraph.add_run(sub)
-                        # Обработка тегов изображений <img>
-                        elif element.name == 'img':
-                            src = element.get('src')
-                            if src:
-                                try:
-                                    # Формируем полный путь к изображению внутри EPUB
-                                    image_href = posixpath.normpath(posixpath.join(html_base_path, src))
-                                    # Ищем элемент изображения в книге по его пути (href)
-                                    img_item = book.get_item_with_href(image_href)
-
-                                    if img_item and img_item.get_type() == ebooklib.ITEM_IMAGE:
-                                        # Получаем бинарные данные изображения
-                                        image_data = img_item.content
-                                        try:
-                                            f = io.BytesIO()
-                                            Image.open(io.BytesIO(image_data)).convert('RGB').save(f, format='JPEG', quality=70)
-                                            document.add_picture(f, width=Inches(5.5))
-                                        except Exception as img_e:
-                                            print(f"EPUB: Ошибка добавления изображения '{image_href}' в DOCX: {img_e}")
-                                            document.add_paragraph(f"[Ошибка добавления изображения: {image_href}]")
-                                    else:
-                                        print(f"Предупреждение: Не найден элемент изображения или тип не ITEM_IMAGE для href: {image_href} (src: {src})")
-                                except KeyError:
-                                    # Если get_item_with_href не нашел элемент
-                                     print(f"Предупреждение: Не найден элемент изображения в манифесте EPUB для href: {image_href} (src: {src}) в файле {item.get_name()}")
-                                except Exception as img_e:
-                                    print(f"Ошибка при обработке изображения {src} в файле {item.get_name()}: {img_e}")
+            with image_stream:
+                data = image_stream.read()
         except Exception as e:
-            print(f"Ошибка конвертации EPUB {epub_file}: {e}")
-            document.add_paragraph(f"Ошибка конвертации файла {os.path.basename(epub_file)}: {e}")
-        finally:
-            document.save(docx_file)
+            # Поврежденный элемент архива (CRC, обрыв) заменяем заглушкой, а не теряем остаток книги
+            print(f"{self.images.prefix}: Ошибка чтения изображения '{label}': {e}")
+            self._add_run(f"[Ошибка добавления изображения: {label}]")
+            return
+        # Изображение встанет на это место, когда будет перекодировано
+        self.images.add(self.model.add_slot(self.paragraph), data, label)
+        self.has_runs = False
+
+# Способ чтения EPUB: "lazy" — напрямую из ZIP по требованию, "ebooklib" — загрузка всей книги
+EPUB_READER = os.getenv("EPUB_READER", "lazy")
+EPUB_DOCUMENT_TYPES = ("application/xhtml+xml", "text/html")
+
+class LazyEpub:
+    """
+    Читает EPUB прямо из ZIP-архива: при открытии разбираются только container.xml и OPF,
+    документы spine и изображения читаются из архива по одному, когда они нужны.
+    Шрифты, стили и неиспользуемые изображения не читаются вовсе.
+    """
+    def __init__(self, epub_file):
+        self.zip = zipfile.ZipFile(epub_file)
+        try:
+            self.names = set(self.zip.namelist())
+            container = etree.fromstring(self.zip.read('META-INF/container.xml'))
+            opf_path = container.find('.//{*}rootfile').get('full-path')
+            opf = etree.fromstring(self.zip.read(opf_path))
+            opf_dir = posixpath.dirname(opf_path)
+            self.manifest = {}  # id -> путь в архиве
+            self.media_types = {}  # путь в архиве -> media-type
+            for item in opf.iterfind('.//{*}manifest/{*}item'):
+                href = item.get('href')
+                if not href:
+                    continue
+                path = posixpath.normpath(posixpath.join(opf_dir, unquote(href)))
+                self.manifest[item.get('id')] = path
+                self.media_types[path] = item.get('media-type', '')
+            self.spine = [itemref.get('idref') for itemref in opf.iterfind('.//{*}spine/{*}itemref')]
+        except Exception:
+            # Процесс пула живет долго: архив битой книги не должен оставаться открытым
+            self.zip.close()
+            raise
+
+    def documents(self):
+        """Отдает (путь, содержимое) документов spine по одному."""
+        for id_ in self.spine:
+            path = self.manifest.get(id_)
+            if path and self.media_types.get(path) in EPUB_DOCUMENT_TYPES:
+                yield path, self.zip.read(path)
+
+    def resolve(self, base_path, src):
+        return posixpath.normpath(posixpath.join(base_path, unquote(src.split('#')[0])))
+
+    def open_image(self, path):
+        """Открывает изображение из архива как поток, не читая его в память целиком."""
+        if not self.media_types.get(path, '').startswith('image/') or path not in self.names:
+            return None
+        return self.zip.open(path)
 
-    return await run_in_threadpool(_convert)
+    def close(self):
+        self.zip.close()
 
-async def convert_fb2_to_docx(fb2_file, docx_file):
-    def _convert():
-        document = Document()
-        image_data_map = {} # Словарь для раскодированных изображений {id: image_bytes}
-        try:
-            with open(fb2_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-            soup = BeautifulSoup(content, 'xml')
-            # Извлечение и декодирование всех изображений
-            for binary_tag in soup.find_all('binary'):
-                image_id = binary_tag.get('id')
-                content_type = binary_tag.get('content-type', '')
-                data = binary_tag.text.strip()
-                if image_id and data and content_type.startswith('image/'):
-                    try:
-                        image_bytes = base64.b64decode(data)
-                        image_data_map[image_id] = image_bytes
-                    except Exception as b64e:
-                        print(f"FB2: Ошибка декодирования base64 для ID '{image_id}': {b64e}")
-            # Парсим остальные части документа
-            for element in soup.find_all(['title', 'p', 'image']):
-                if element.name == 'title':
-                    document.add_heading(element.get_text(), level=1)
-                elif element.name == 'p':
-                    # Если абзац не является частью title или annotation
-                    if element.find_parent(['title', 'annotation']) is None:
-                        doc_paragraph = document.add_paragraph()
-                        for sub in element.contents:
-                            if hasattr(sub, 'name'):
-                                if sub.name == 'strong':
-                                    run = doc_paragraph.add_run(sub.get_text())
-                                    run.bold = True
-                                elif sub.name == 'emphasis':
-                                    run = doc_paragraph.add_run(sub.get_text())
-                                    run.italic = True
-                                else:
-                                    doc_paragraph.add_run(sub.get_text())
-                            else:
-                                doc_paragraph.add_run(sub)
+class EbooklibEpub:
+    """Прежний способ: ebooklib загружает в память все элементы книги."""
+    def __init__(self, epub_file):
+        self.book = epub.read_epub(epub_file)
+
+    def documents(self):
+        for id_, _ in self.book.spine:
+            item = self.book.get_item_with_id(id_)
+            if item is not None and item.get_type() == ebooklib.ITEM_DOCUMENT:
+                yield item.get_name(), item.content
+
+    def resolve(self, base_path, src):
+        return posixpath.normpath(posixpath.join(base_path, src))
+
+    def open_image(self, path):
+        img_item = self.book.get_item_with_href(path)
+        if img_item is None or img_item.get_type() != ebooklib.ITEM_IMAGE:
+            return None
+        return io.BytesIO(img_item.content)
+
+    def close(self):
+        pass
+
+def open_epub(epub_file):
+    if EPUB_READER == "ebooklib":
+        return EbooklibEpub(epub_file)
+    try:
+        return LazyEpub(epub_file)
+    except (KeyError, AttributeError, etree.XMLSyntaxError) as e:
+        # Нестандартный контейнер: пробуем ebooklib
+        print(f"EPUB: не удалось прочитать {epub_file} напрямую ({e}), используется ebooklib")
+        return EbooklibEpub(epub_file)
+
+def _convert_epub(epub_file):
+    model = DocModel(epub_file)
+    book = None
+    images = ImageStage("EPUB")
+    try:
+        # Открываем EPUB-файл
+        book = open_epub(epub_file)
+        # Перебираем документы книги в порядке spine
+        for doc_name, content in book.documents():
+            html_base_path = posixpath.dirname(doc_name)
+
+            def open_image(src, html_base_path=html_base_path, doc_name=doc_name):
+                # Формируем полный путь к изображению внутри EPUB
+                image_href = book.resolve(html_base_path, src)
+                image_stream = book.open_image(image_href)
+                if image_stream is None:
+                    print(f"Предупреждение: Не найден элемент изображения или тип не image для href: {image_href} (src: {src}) в файле {doc_name}")
+                return image_stream, image_href
+
+            HtmlDocxEmitter(model, open_image, images).emit_html(content)
+    except Exception as e:
+        print(f"Ошибка конвертации EPUB {epub_file}: {e}")
+        model.error(f"Ошибка конвертации файла {os.path.basename(epub_file)}: {e}")
+    finally:
+        images.finish()
+        if book is not None:
+            book.close()
+    return model
+
+
+def _local_name(tag):
+    """Имя тега без пространства имен: '{http://...}p' -> 'p'."""
+    return tag.rpartition('}')[2]
+
+def _fb2_href(element):
+    """Значение l:href / xlink:href независимо от префикса пространства имен."""
+    for name, value in element.attrib.items():
+        if _local_name(name) == 'href':
+            return value
+    return None
+
+# Форматирование вложенных в <p> тегов FB2
+FB2_RUN_FORMATS = {'strong': ('bold',), 'emphasis': ('italic',)}
+
+def _convert_fb2(fb2_file):
+    """
+    Потоковая конвертация FB2: файл читается за один проход через iterparse,
+    обработанные элементы сразу освобождаются. Изображения вставляются
+    в абзацы-заглушки, base64 декодируется только для <binary>, на которые есть ссылка,
+    и перекодируется параллельно с разбором (ImageStage).
+    """
+    model = DocModel(fb2_file)
+    images = ImageStage("FB2")
+    pending_images = {}  # {id: [абзацы-заглушки]} — ссылки, для которых еще не встретился <binary>
+    raw_binaries = {}  # {id: base64} — <binary>, встреченные раньше ссылок на них
+    try:
+        skip_depth = 0  # Вложенность в title/annotation: абзацы внутри них не выводятся
+        open_titles = []  # Стек заголовков, текст которых заполняется в конце тега
+        paragraph = None  # Текущий абзац <p>, заполняется в конце тега
+        context = etree.iterparse(fb2_file, events=('start', 'end'), recover=True, huge_tree=True,
+                                  remove_comments=True, remove_pis=True)
+        for event, element in context:
+            name = _local_name(element.tag)
+            if event == 'start':
+                if name == 'title':
+                    open_titles.append(model.add_paragraph('Heading 1'))
+                    skip_depth += 1
+                elif name == 'annotation':
+                    skip_depth += 1
+                elif name == 'p' and skip_depth == 0 and paragraph is None:
+                    paragraph = model.add_paragraph()
                 # Обработка тега image
-                elif element.name == 'image':
-                    href_attr = element.get('l:href') or element.get('xlink:href')
+                elif name == 'image':
+                    href_attr = _fb2_href(element)
                     if href_attr and href_attr.startswith('#'):
                         image_id_ref = href_attr[1:]
-                        if image_id_ref in image_data_map:
-                            image_bytes = image_data_map[image_id_ref]
+                        placeholder = model.add_paragraph()
+                        if image_id_ref in raw_binaries:
                             try:
-                                f = io.BytesIO()
-                                Image.open(io.BytesIO(image_bytes)).convert('RGB').save(f, format='JPEG', quality=70)
-                                document.add_picture(f, width=Inches(5.5))
-                            except Exception as img_e:
-                                print(f"FB2: Ошибка добавления изображения '{image_id_ref}' в DOCX: {img_e}")
-                                document.add_paragraph(f"[Ошибка добавления изображения: {image_id_ref}]")
+                                images.add(model.add_slot(placeholder), base64.b64decode(raw_binaries[image_id_ref]), image_id_ref)
+                            except Exception as b64e:
+                                print(f"FB2: Ошибка декодирования base64 для ID '{image_id_ref}': {b64e}")
+                                model.add_run(placeholder, f"[Изображение не найдено: {image_id_ref}]")
                         else:
-                            print(f"FB2: Данные для изображения '{image_id_ref}' не найдены.")
-                            document.add_paragraph(f"[Изображение не найдено: {image_id_ref}]")
+                            pending_images.setdefault(image_id_ref, []).append(placeholder)
                     else:
-                        print(f"FB2: Тег <image> без корректной ссылки: {element}")
-                        document.add_paragraph("[Некорректный тег image]")
-        except Exception as e:
-            print(f"Ошибка конвертации FB2 {fb2_file}: {e}")
-            document.add_paragraph(f"Ошибка конвертации файла {os.path.basename(fb2_file)}: {e}")
-        finally:
-            document.save(docx_file)
-    return await run_in_threadpool(_convert)
+                        print(f"FB2: Тег <image> без корректной ссылки: {dict(element.attrib)}")
+                        model.add_paragraph(text="[Некорректный тег image]")
+                continue
+
+            # event == 'end'
+            if name == 'title':
+                model.add_run(open_titles.pop(), ''.join(element.itertext()))
+                skip_depth -= 1
+            elif name == 'annotation':
+                skip_depth -= 1
+            elif name == 'p' and paragraph is not None and skip_depth == 0:
+                if element.text:
+                    model.add_run(paragraph, element.text)
+                for sub in element:
+                    sub_text = ''.join(sub.itertext())
+                    if sub_text:
+                        model.add_run(paragraph, sub_text, FB2_RUN_FORMATS.get(_local_name(sub.tag), ()))
+                    if sub.tail:
+                        model.add_run(paragraph, sub.tail)
+                paragraph = None
+            elif name == 'binary':
+                image_id = element.get('id')
+                content_type = element.get('content-type', '')
+                data = (element.text or '').strip()
+                if image_id and data and content_type.startswith('image/'):
+                    if image_id in pending_images:
+                        try:
+                            image_bytes = base64.b64decode(data)
+                        except Exception as b64e:
+                            print(f"FB2: Ошибка декодирования base64 для ID '{image_id}': {b64e}")
+                        else:
+                            for placeholder in pending_images.pop(image_id):
+                                images.add(model.add_slot(placeholder), image_bytes, image_id)
+                    else:
+                        raw_binaries[image_id] = data
+
+            # Освобождаем обработанные элементы, если они не нужны открытому title/p
+            if not open_titles and paragraph is None:
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        del context
+    except Exception as e:
+        print(f"Ошибка конвертации FB2 {fb2_file}: {e}")
+        model.error(f"Ошибка конвертации файла {os.path.basename(fb2_file)}: {e}")
+    finally:
+        # Ссылки, для которых так и не нашлось данных
+        for image_id_ref, paragraphs in pending_images.items():
+            print(f"FB2: Данные для изображения '{image_id_ref}' не найдены.")
+            for placeholder in paragraphs:
+                model.add_run(placeholder, f"[Изображение не найдено: {image_id_ref}]")
+        images.finish()
+    return model
+
+
+# Частые строчные буквы русского текста: по ним выбирается однобайтовая кодировка
+RUSSIAN_FREQUENT_LETTERS = set('оеаинтсрвлкмдпуяыь')
+
+def detect_text_encoding(path, sample_size=64 * 1024):
+    """
+    Определяет кодировку текстового файла по его началу:
+    BOM (UTF-8/UTF-16), UTF-16 без BOM по старшим байтам, валидный UTF-8,
+    иначе cp1251 или koi8-r — у какой больше частых строчных русских букв.
+    """
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if len(sample) >= 2:
+        # UTF-16 без BOM: старший байт почти всех символов — 0x00 (латиница) или 0x04 (кириллица)
+        for encoding, high_bytes in (('utf-16-le', sample[1::2]), ('utf-16-be', sample[0::2])):
+            if high_bytes.count(0) + high_bytes.count(4) > len(high_bytes) * 0.9:
+                return encoding
+    try:
+        # final=False: последний символ может быть обрезан границей выборки
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    scores = {}
+    for encoding in ('cp1251', 'koi8-r'):
+        text = sample.decode(encoding, errors='replace')
+        scores[encoding] = sum(1 for ch in text if ch in RUSSIAN_FREQUENT_LETTERS)
+    return max(scores, key=scores.get)
+
+def _iter_text_lines(f):
+    """Строки файла по правилам str.splitlines(), без чтения файла целиком."""
+    for line in f:
+        yield from line.splitlines() or ['']
+
+def _convert_txt(txt_file):
+    model = DocModel(txt_file)
+    try:
+        encoding = detect_text_encoding(txt_file)
+        with open(txt_file, 'r', encoding=encoding, errors='replace') as f:
+            model.add_plain_paragraphs(_iter_text_lines(f))
+    except Exception as e:
+        print(f"Ошибка конвертации TXT {txt_file}: {e}")
+        # Документ с сообщением об ошибке, чтобы процесс не падал
+        model = DocModel(txt_file)
+        model.error(f"Ошибка конвертации файла {os.path.basename(txt_file)}: {e}")
+    return model
+
+
+# ===================== Запуск конвертеров в пуле =====================
+CONVERTERS = {
+    ".txt": _convert_txt,
+    ".fb2": _convert_fb2,
+    ".epub": _convert_epub,
+}
 
-async def convert_txt_to_docx(txt_file, docx_file):
-    def _convert():
+def _convert_to_model_blob(file):
+    """
+    Выполняется в воркере: конвертирует файл и возвращает (успех, модель в pickle, сведения),
+    где сведения — время перекодирования изображений, число изображений и абзацев.
+    """
+    seconds_before, added_before = _image_seconds, _images_added
+    model = CONVERTERS[os.path.splitext(file)[1].lower()](file)
+    info = {'image_seconds': _image_seconds - seconds_before, 'images': _images_added - added_before,
+            'paragraphs': len(model.paragraphs)}
+    return model.ok, model.dumps(), info
+
+def _convert_to_docx(file, docx_file):
+    """Выполняется в воркере: конвертирует файл в отдельный .docx."""
+    model = CONVERTERS[os.path.splitext(file)[1].lower()](file)
+    model.save(docx_file)
+    return model.ok
+
+# ===================== Кэш конвертированных файлов =====================
+# Версия конвертеров: меняется при любом изменении результата конвертации,
+# чтобы старые записи кэша не использовались
+CONVERTER_VERSION = "8"
+# Настройки изображений тоже меняют результат: входят в ключ кэша вместе с версией
+CONVERTER_SETTINGS = f"{CONVERTER_VERSION}:{IMAGE_DPI}:{IMAGE_JPEG_QUALITY}:{IMAGE_WIDTH}"
+CACHE_TMP_GRACE = 3600  # Секунд, после которых недописанный временный файл считается брошенным
+CACHE_DIR = os.getenv("CACHE_DIR", "docx_cache")
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", 500))  # 0 — кэш отключен
+
+class ConversionCache:
+    """
+    Кэш сконвертированных файлов (DocModel в pickle) на диске.
+    Ключ — sha256 от версии и настроек конвертеров, расширения и содержимого исходного файла.
+    При превышении max_bytes удаляются давно не использованные записи (LRU).
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> размер файла, от старых к новым
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # Методы вызываются из разных потоков (asyncio.to_thread)
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        """Восстанавливает индекс по файлам в каталоге, порядок LRU — по времени изменения."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith(".model"):
+                files.append((stat.st_mtime, entry.name[:-6], stat.st_size))
+            elif not entry.name.endswith(".tmp") or stat.st_mtime < time.time() - CACHE_TMP_GRACE:
+                # Записи старого формата и брошенные временные файлы; свежие .tmp может
+                # дописывать другой процесс с тем же каталогом (воркеры в режиме frontend/worker)
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".model")
+
+    def key_for(self, file):
+        """Считает ключ кэша, читая файл по частям."""
+        digest = hashlib.sha256()
+        digest.update(f"{CONVERTER_SETTINGS}:{os.path.splitext(file)[1].lower()}:".encode())
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Возвращает сохраненную модель (pickle) или None при промахе."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
         try:
-            with open(txt_file, 'r', encoding='utf-8') as f:
-                text = f.read()
-            document = Document()
-            for line in text.splitlines():
-                document.add_paragraph(line)
-        except Exception as e:
-            print(f"Ошибка конвертации TXT {txt_file}: {e}")
-            # Создаем пустой docx или с сообщением об ошибке, чтобы процесс не падал
-            document = Document()
-            document.add_paragraph(f"Ошибка конвертации файла {os.path.basename(txt_file)}: {e}")
-        finally:
-            document.save(docx_file)
+            with open(self._path(key), 'rb') as f:
+                blob = f.read()
+            os.utime(self._path(key))  # Для восстановления порядка LRU после перезапуска
+        except OSError as e:
+            print(f"Кэш: запись {key} недоступна: {e}")
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return blob
+
+    def put(self, key, blob):
+        """Сохраняет модель в кэш и вытесняет старые записи."""
+        tmp_path = self._path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, self._path(key))  # Атомарно: читатели не увидят недописанный файл
+        size = len(blob)
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+        }
+
+conversion_cache = ConversionCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
+
+# Максимум файлов одной задачи, конвертируемых одновременно
+MAX_FILES_IN_FLIGHT = int(os.getenv("MAX_FILES_IN_FLIGHT", EXECUTOR_WORKERS))
 
-    return await run_in_threadpool(_convert)
+def _error_model_blob(file, e):
+    model = DocModel(file)
+    model.error(f"Ошибка конвертации файла {os.path.basename(file)}: {e}")
+    return model.dumps()
+
+async def convert_file(file, semaphore):
+    """
+    Конвертирует один файл в модель (pickle), ограничивая число одновременных конвертаций.
+    Ошибка не прерывает остальные файлы: в результат пишется абзац с ошибкой.
+    """
+    file_format = os.path.splitext(file)[1].lower().lstrip(".")
+    with tracer.span(f"convert_{file_format}", **{"file.name": os.path.basename(file), "file.format": file_format}) as attributes:
+        key = None
+        if conversion_cache.enabled:
+            try:
+                key = await asyncio.to_thread(conversion_cache.key_for, file)
+                blob = await asyncio.to_thread(conversion_cache.get, key)
+                attributes["cache.hit"] = blob is not None
+                if blob is not None:
+                    return blob
+            except OSError as e:
+                print(f"Кэш недоступен для {file}: {e}")
+                key = None
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                report = current_profile.get()
+                if report is None:
+                    converted, blob, info = await run_in_executor(_convert_to_model_blob, file)
+                else:
+                    converted, blob, info = await report.call(f"Конвертация {os.path.basename(file)}", _convert_to_model_blob, file)
+                IMAGE_SECONDS.observe(info['image_seconds'], file_format)
+                attributes.update(paragraphs=info['paragraphs'], images=info['images'])
+            except Exception as e:
+                print(f"Ошибка конвертации {file}: {e}")
+                converted, blob = False, _error_model_blob(file, e)
+            CONVERT_SECONDS.observe(time.perf_counter() - start_time, file_format)
+        attributes.update(**{"file.size": os.path.getsize(file) if os.path.exists(file) else None, "converted": converted})
+        if not converted:
+            CONVERSION_ERRORS.inc(file_format)
+        # Кэшируем только успешные конвертации
+        if key is not None and converted:
+            try:
+                await asyncio.to_thread(conversion_cache.put, key, blob)
+            except OSError as e:
+                print(f"Не удалось сохранить {file} в кэш: {e}")
+        return blob
+
+# ===================== Предварительная конвертация =====================
+SPECULATIVE_WORKERS = int(os.getenv("SPECULATIVE_WORKERS", 1))  # Одновременных предварительных конвертаций
+SPECULATIVE_MAX_MB = int(os.getenv("SPECULATIVE_MAX_MB", 200))  # Лимит памяти под готовые результаты
+
+class SpeculativeConverter:
+    """
+    Конвертирует файлы сразу после загрузки, пока пользователь еще отправляет остальные.
+    Работа низкоприоритетная: не больше max_workers конвертаций одновременно, и новая
+    конвертация начинается только когда в очереди нет задач и ни одна задача не выполняется.
+    Готовые модели забирает process_files; при /cancel результаты выбрасываются.
+    """
+    def __init__(self, max_workers, max_bytes, enabled=True):
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.jobs = {}  # путь к файлу -> {'task': asyncio.Task, 'started': bool, 'size': int, 'taken': bool}
+        self.results_bytes = 0  # Объем готовых, но еще не забранных результатов
+        self.hits = 0
+        self.discarded = 0
+
+    def schedule(self, file):
+        """Ставит файл на предварительную конвертацию, если есть место под результат."""
+        if not self.enabled or os.path.splitext(file)[1].lower() not in CONVERTERS or file in self.jobs:
+            return
+        if self.results_bytes >= self.max_bytes:
+            return
+        job = {'task': None, 'started': False, 'size': 0, 'taken': False}
+        job['task'] = asyncio.create_task(self._run(file, job))
+        self.jobs[file] = job
+
+    async def _run(self, file, job):
+        async with self.semaphore:
+            # Уступаем пул настоящим задачам
+            while task_queue.queue or task_queue.active_tasks:
+                await asyncio.sleep(1)
+            job['started'] = True
+            blob = await convert_file(file, asyncio.Semaphore(1))
+        if job['taken']:
+            return blob  # Задача уже ждет этот результат: в памяти конвертера он не хранится
+        if self.jobs.get(file) is not job:
+            return None  # Результат уже не нужен
+        if self.results_bytes + len(blob) > self.max_bytes:
+            # Не держим в памяти больше лимита: задача сконвертирует файл сама (или возьмет из кэша)
+            del self.jobs[file]
+            self.discarded += 1
+            return None
+        job['size'] = len(blob)
+        self.results_bytes += job['size']
+        return blob
+
+    async def take(self, file, semaphore):
+        """
+        Результат для process_files: готовая или уже идущая предварительная конвертация,
+        иначе обычная конвертация (ожидающая предварительная при этом отменяется).
+        """
+        job = self.jobs.pop(file, None)
+        if job is not None:
+            if job['started'] or job['task'].done():
+                job['taken'] = True  # Идущая конвертация отдаст результат нам, а не выбросит его
+                try:
+                    blob = await job['task']
+                except Exception:
+                    blob = None
+                self.results_bytes -= job['size']
+                if blob is not None:
+                    self.hits += 1
+                    return blob
+            else:
+                job['task'].cancel()
+        return await convert_file(file, semaphore)
+
+    async def result(self, file):
+        """
+        Ждет предварительную конвертацию файла, не повышая ее приоритет, и забирает результат.
+        None, если конвертация не запускалась, была отменена или результат не поместился в лимит.
+        """
+        job = self.jobs.get(file)
+        if job is None:
+            return None
+        try:
+            # shield: отмена ожидающего не должна отменять саму конвертацию
+            blob = await asyncio.shield(job['task'])
+        except Exception:
+            blob = None
+        if self.jobs.get(file) is job:
+            del self.jobs[file]
+            self.results_bytes -= job['size']
+            if blob is not None:
+                self.hits += 1
+        return blob
+
+    def discard(self, files):
+        """Отменяет предварительную конвертацию и выбрасывает результаты (например, при /cancel)."""
+        for file in files:
+            job = self.jobs.pop(file, None)
+            if job is not None:
+                job['task'].cancel()
+                self.results_bytes -= job['size']
+                self.discarded += 1
+
+# В режиме frontend конвертацией занимаются воркеры, поэтому заранее ничего не конвертируем
+speculative = SpeculativeConverter(SPECULATIVE_WORKERS, SPECULATIVE_MAX_MB * 1024 * 1024, enabled=PROCESS_ROLE == "standalone")
 
 @timer
 async def process_files(file_list):
     """
-    Обрабатывает список файлов, конвертируя их в формат .docx (если требуется)
-    и возвращает список имен файлов в формате .docx для последующего объединения.
+    Обрабатывает список файлов для последующего объединения: .docx остаются путями,
+    остальные форматы конвертируются в модели (DocModel в pickle) без промежуточных .docx.
+    Файлы конвертируются параллельно, порядок результата совпадает с file_list.
     """
-    converted_files = []
+    semaphore = asyncio.Semaphore(MAX_FILES_IN_FLIGHT)
+    jobs = []
     for file in file_list:
         ext = os.path.splitext(file)[1].lower()
         # Если файл уже в формате .docx – добавляем его в список
         if ext == ".docx":
-            converted_files.append(file)
-        elif ext == ".txt":
-            docx_file = os.path.splitext(file)[0] + ".docx"
-            await convert_txt_to_docx(file, docx_file)
-            converted_files.append(docx_file)
-        elif ext == ".fb2":
-            docx_file = os.path.splitext(file)[0] + ".docx"
-            await convert_fb2_to_docx(file, docx_file)
-            converted_files.append(docx_file)
-        elif ext == ".epub":
-            docx_file = os.path.splitext(file)[0] + ".docx"
-            await convert_epub_to_docx(file, docx_file)
-            converted_files.append(docx_file)
+            jobs.append(asyncio.sleep(0, result=file))
+        elif ext in CONVERTERS:
+            jobs.append(speculative.take(file, semaphore))
+    converted_files = list(await asyncio.gather(*jobs))
     return converted_files
 
 # ===================== Неблокирующие функции для работы с документами =====
@@ -430,26 +2307,53 @@ def safe_docx(doc):
     composer.append(doc)
     return check
     
+TITLE_PATTERNS = [
+    r'Глава[ ]{0,4}\d{1,4}',
+    r'Часть[ ]{0,4}\d{1,4}',
+    r'^Пролог[ .!]*$',
+    r'^Описание[ .!]*$',
+    r'^Аннотация[ .!]*$',
+    r'^Annotation[ .!]*$',
+    r'^Предисловие от автора[ .!]*$'
+]
+
+def is_heading_style(style_name):
+    return any(style_name.lower().startswith(prefix) for prefix in ["heading", "заголовок"])
+
+def title_from_file_name(file_name):
+    title = os.path.splitext(os.path.basename(file_name))[0]
+    if re.fullmatch(r'\d+', title.strip()):
+        title = 'Глава ' + title
+    return title
+
+def check_and_add_title_model(model):
+    """То же, что check_and_add_title, для DocModel."""
+    if not model.paragraphs:
+        return model
+    check_paragraphs = model.paragraphs[0:4]
+    if any(style and is_heading_style(style) for style, _ in check_paragraphs):
+        return model
+    for p in check_paragraphs:
+        text = model.text(p).strip()
+        if any(re.search(pattern, text) for pattern in TITLE_PATTERNS):
+            p[0] = 'Heading 1'
+            return model
+    # Добавляем заголовок перед первым абзацем
+    model.paragraphs.insert(0, ['Heading 1', [(title_from_file_name(model.name), ())]])
+    return model
+
 def check_and_add_title(doc, file_name):
     """
     Проверяет первые абзацы документа на наличие заголовка (например, "Глава ...").
     Если заголовок не найден, добавляет его на основе имени файла.
     """
-    patterns = [
-        r'Глава[ ]{0,4}\d{1,4}',
-        r'Часть[ ]{0,4}\d{1,4}',
-        r'^Пролог[ .!]*$',
-        r'^Описание[ .!]*$',
-        r'^Аннотация[ .!]*$',
-        r'^Annotation[ .!]*$',
-        r'^Предисловие от автора[ .!]*$'
-    ]
+    patterns = TITLE_PATTERNS
     if doc.paragraphs:
         check_paragraphs = doc.paragraphs[0:4]
         title_found = False
         c = 0
         for p in check_paragraphs:
-            if any(p.style.name.lower().startswith(prefix) for prefix in ["heading", "заголовок"]):
+            if is_heading_style(p.style.name):
                 title_found = True
                 break
 
@@ -474,9 +2378,7 @@ def check_and_add_title(doc, file_name):
 
         if not title_found:
             # Добавляем заголовок перед первым абзацем
-            title = os.path.splitext(os.path.basename(file_name))[0]
-            if re.fullmatch(r'\d+', title.strip()):
-                title = 'Глава ' + title
+            title = title_from_file_name(file_name)
             try:
                 paragraph = doc.paragraphs[0].insert_paragraph_before(title)
                 paragraph.style = 'Heading 1'
@@ -490,38 +2392,830 @@ def check_and_add_title(doc, file_name):
                     print(f"Возникла ошибка при добавлении заголовка: {e}")
     return doc
 
+def _append_merged(composer, merged_document, file, name, title_times=None, spans=None):
+    """
+    Добавляет в итоговый документ один результат process_files (модель или путь .docx);
+    name — путь к исходному файлу, по нему строятся заголовок и сообщения об ошибках.
+    Время поиска заголовка добавляется в список title_times, спан добавления —
+    в список spans как (имя, начало, конец, атрибуты) для Tracer.record.
+    """
+    try:
+        if isinstance(file, bytes):
+            model = DocModel.loads(file, name)
+            start_time = time.perf_counter()
+            model = check_and_add_title_model(model)
+            if title_times is not None:
+                title_times.append(time.perf_counter() - start_time)
+            start = time.time_ns()
+            render_model(model, merged_document)
+            if spans is not None:
+                spans.append(("render_model", start, time.time_ns(),
+                              {"file.name": os.path.basename(name), "paragraphs": len(model.paragraphs)}))
+        else:
+            doc = Document(file)
+            start_time = time.perf_counter()
+            doc = check_and_add_title(doc, file)
+            if title_times is not None:
+                title_times.append(time.perf_counter() - start_time)
+            start = time.time_ns()
+            composer.append(doc)
+            if spans is not None:
+                spans.append(("composer.append", start, time.time_ns(),
+                              {"file.name": os.path.basename(file), "paragraphs": len(doc.paragraphs)}))
+    except Exception as e:
+        print(f"Ошибка добавления файла {name}: {e}")
+        merged_document.add_paragraph(f"Ошибка добавления файла {os.path.basename(name)}: {e}")
+
+def _merge_docx(file_list, output_file_name, base=None, names=None):
+    """
+    Объединяет результаты process_files: модели (pickle) выводятся прямо в итоговый документ,
+    через Composer проходят только настоящие .docx. names — исходные файлы в том же порядке
+    (имена для заголовков; по умолчанию file_list). Если указан base, файлы дописываются
+    к этому сохраненному документу (контрольной точке предварительного объединения).
+    Возвращает (имя итогового файла, время поиска заголовков по файлам, спаны для трассировки).
+    """
+    # Создаем новый документ или продолжаем сохраненный
+    merged_document = Document(base) if base else Document()
+    composer = Composer(merged_document)
+    title_times = []
+    spans = []
+    try:
+        for file, name in zip(file_list, names or file_list):
+            _append_merged(composer, merged_document, file, name, title_times, spans)
+    except Exception as e:
+        print(f"Критическая ошибка, невозможно пройтись по списку файлов: {e}")
+        merged_document.add_paragraph(f"Критическая ошибка, невозможно пройтись по списку файлов: {e}")
+    finally:
+        start = time.time_ns()
+        composer.save(output_file_name)
+        spans.append(("composer.save", start, time.time_ns(), {"paragraphs": len(merged_document.paragraphs)}))
+        print(f"Файлы объединены в {output_file_name}")
+        return output_file_name, title_times, spans
+
 @timer
-async def merge_docx(file_list, output_file_name):
-    def _merge():
-        # Создаем новый документ
-        merged_document = Document()
-        composer = Composer(merged_document)
+async def merge_docx(file_list, output_file_name, names=None):
+    # Объединяем обработанные файлы в пуле; names — исходные файлы (для заголовков)
+    with tracer.span("merge", files=len(file_list)):
+        start_time = time.perf_counter()
+        report = current_profile.get()
+        if report is None:
+            output_file_name, title_times, spans = await run_in_executor(_merge_docx, file_list, output_file_name, None, names)
+        else:
+            output_file_name, title_times, spans = await report.call("Объединение", _merge_docx, file_list, output_file_name, None, names)
+        MERGE_SECONDS.observe(time.perf_counter() - start_time, "full")
+        for seconds in title_times:
+            TITLE_SECONDS.observe(seconds)
+        # Спаны из процесса пула: время по общим часам, родитель — спан merge
+        for name, start, end, attributes in spans:
+            tracer.record(name, start, end, attributes)
+    return output_file_name
+
+# ===================== Инкрементальное объединение =====================
+PREMERGE_ENABLED = os.getenv("PREMERGE_ENABLED", "1") == "1"
+PREMERGE_CHECKPOINT_EVERY = int(os.getenv("PREMERGE_CHECKPOINT_EVERY", 5))  # Файлов в пачке и до первой контрольной точки
+PREMERGE_MAX_MB = int(os.getenv("PREMERGE_MAX_MB", 256))  # Общий лимит моделей во всех сессиях
+
+# Документы сессий живут открытыми в отдельном процессе: пачки дописываются к ним без
+# повторного открытия, а работа с Composer не отнимает GIL у цикла событий
+premerge_executor = create_executor(EXECUTOR_BACKEND, 1)
+_premerge_documents = {}  # id сессии -> (документ, Composer), в процессе premerge_executor
+
+def _premerge_open(session_id, base):
+    """Выполняется в процессе объединения: открывает документ сессии с контрольной точки base (или пустой)."""
+    document = Document(base) if base else Document()
+    _premerge_documents[session_id] = (document, Composer(document))
+
+def _premerge_append(session_id, items, names, output_file_name=None):
+    """
+    Выполняется в процессе объединения: дописывает items к открытому документу сессии
+    и, если указан output_file_name, сохраняет его туда (контрольная точка или итоговый файл).
+    Возвращает (время поиска заголовков, спаны для трассировки).
+    """
+    document, composer = _premerge_documents[session_id]
+    title_times = []
+    spans = []
+    for item, name in zip(items, names):
+        _append_merged(composer, document, item, name, title_times, spans)
+    if output_file_name:
+        start = time.time_ns()
+        composer.save(output_file_name)
+        spans.append(("composer.save", start, time.time_ns(), {"paragraphs": len(document.paragraphs)}))
+    return title_times, spans
+
+def _premerge_close(session_id):
+    _premerge_documents.pop(session_id, None)
+
+async def run_in_premerge(func, *args):
+    global premerge_executor
+    current = premerge_executor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(current, partial(func, *args))
+    except concurrent.futures.process.BrokenProcessPool:
+        # Открытые документы погибли вместе с процессом: их сессии объединятся обычным путем
+        if premerge_executor is current:
+            premerge_executor = create_executor(EXECUTOR_BACKEND, 1)
+            current.shutdown(wait=False, cancel_futures=True)
+        raise
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+class MergeSession:
+    """
+    Итоговый документ одной сессии сбора, собираемый по мере поступления файлов.
+    Файлы добавляются по возрастанию message_id пачками по PREMERGE_CHECKPOINT_EVERY.
+    Контрольные точки сохраняются в рабочий каталог сессии, когда документ вырос вдвое
+    с прошлой, а модели уже добавленных файлов вытесняются туда же: в памяти остаются
+    только модели, ждущие своей пачки.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.id = next(self._ids)  # Ключ документа в процессе объединения
+        self.entries = []        # [(message_id, файл)] по возрастанию message_id
+        self.ready = {}          # файл -> модель (pickle) или путь .docx, еще не вытесненные на диск
+        self.spilled = {}        # файл -> путь к вытесненной модели
+        self.sizes = {}          # файл -> размер, учтенный в лимите
+        self.waiters = {}        # файл -> asyncio.Task, ожидающий предварительную конвертацию
+        self.tasks = set()       # Задачи _advance
+        self.checkpoints = [(0, None)]  # [(число файлов, путь)]; 0 — пустой документ
+        self.opened = False      # Документ открыт в процессе объединения
+        self.merged = 0          # Сколько первых entries уже в документе
+        self.appending = 0       # Сколько entries после merged сейчас дописывается
+        self.rollback_to = None  # Позиция самого раннего файла, вставшего перед уже добавленными
+        self.workspace = None    # Рабочий каталог сессии (каталог загруженных файлов)
+        self.bytes = 0           # Объем моделей сессии, учтенный в лимите
+        self.failed = False
+        self.closed = False
+        self.lock = asyncio.Lock()
+        self.trace = current_span.get()  # Трасса сессии сбора, в которой создан документ
+
+class PreMerger:
+    """
+    Объединяет файлы еще во время сбора, чтобы после /end_merge оставалось дописать последние файлы.
+    Файл, пришедший раньше уже добавленных (по message_id), возвращает документ к ближайшей
+    контрольной точке не дальше своей позиции, и файлы после нее дописываются заново.
+    Если модели сессий не помещаются в max_bytes или что-то пошло не так, сессия бросается,
+    и задача объединяет файлы обычным путем.
+    """
+    def __init__(self, enabled, max_bytes):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.sessions = {}  # (chat_id, user_id) -> MergeSession, пока идет сбор
+        self.bound = {}     # task_id -> MergeSession, после постановки задачи в очередь
+        self.cleanups = set()  # Задачи закрытия брошенных сессий
+        self.bytes = 0      # Объем моделей во всех сессиях (в памяти, на диске и в открытых документах)
+        self.rollbacks = 0
+        self.overflows = 0  # Сессии, брошенные из-за лимита памяти
+
+    def add(self, key, file, message_id):
+        """Добавляет загруженный файл в сессию сбора."""
+        if not self.enabled:
+            return
+        session = self.sessions.setdefault(key, MergeSession())
+        if session.failed:
+            return
+        session.workspace = session.workspace or os.path.dirname(file)
+        position = bisect.bisect(session.entries, (message_id, file))
+        session.entries.insert(position, (message_id, file))
+        if position < session.merged + session.appending:
+            session.rollback_to = position if session.rollback_to is None else min(session.rollback_to, position)
+        if os.path.splitext(file)[1].lower() == ".docx":
+            if self._accept(session, file, file, os.path.getsize(file)):
+                self._kick(session)
+        else:
+            session.waiters[file] = asyncio.create_task(self._wait(session, file))
+
+    def _accept(self, session, file, item, size):
+        """Учитывает модель в лимите и кладет ее в ready; False, если сессия брошена из-за лимита."""
+        if self.bytes + size > self.max_bytes:
+            print(f"Предварительное объединение остановлено: модели не помещаются в {self.max_bytes // (1024 * 1024)} МБ")
+            self.overflows += 1
+            self._fail(session)
+            return False
+        session.ready[file] = item
+        session.sizes[file] = size
+        session.bytes += size
+        self.bytes += size
+        return True
+
+    async def _wait(self, session, file):
+        blob = await speculative.result(file)
+        session.waiters.pop(file, None)
+        if blob is not None and not session.failed and self._accept(session, file, blob, len(blob)):
+            self._kick(session)
+
+    def _kick(self, session):
+        """Запускает дообъединение; задача хранится в сессии, чтобы ее можно было дождаться или отменить."""
+        task = asyncio.create_task(self._advance(session))
+        session.tasks.add(task)
+        task.add_done_callback(session.tasks.discard)
+
+    async def _advance(self, session):
+        async with session.lock:
+            await self._catch_up(session)
+
+    async def _item(self, session, file):
+        if file in session.ready:
+            return session.ready[file]
+        return await asyncio.to_thread(_read_file, session.spilled[file])
+
+    async def _spill(self, session, files):
+        """Вытесняет модели добавленных файлов на диск: они нужны только для повторного добавления."""
+        for file in files:
+            item = session.ready.get(file)
+            if isinstance(item, bytes) and file not in session.spilled:
+                fd, path = tempfile.mkstemp(prefix=".premerge-", suffix=".model", dir=session.workspace)
+                os.close(fd)
+                await asyncio.to_thread(_write_file, path, item)
+                session.spilled[file] = path
+            if file in session.spilled:
+                session.ready.pop(file, None)
+
+    async def _rewind(self, session):
+        """Открывает документ с ближайшей контрольной точки не дальше rollback_to (или пустой при первом запуске)."""
+        position = session.rollback_to if session.rollback_to is not None else 0
+        session.rollback_to = None
+        while session.checkpoints[-1][0] > position:
+            _, path = session.checkpoints.pop()
+            os.remove(path)
+        count, base = session.checkpoints[-1]
+        if session.opened:
+            self.rollbacks += 1
+        await run_in_premerge(_premerge_open, session.id, base)
+        session.opened = True
+        session.merged = count
+
+    async def _catch_up(self, session, final=False):
+        """
+        Дописывает готовые файлы подряд, начиная с первого недобавленного, полными пачками
+        (при final — и неполную последнюю). Контрольная точка сохраняется, когда с прошлой
+        добавлено не меньше файлов, чем в ней: суммарно сохранения линейны по размеру документа.
+        """
         try:
-            for file in file_list:
+            while not session.failed:
+                if not session.opened or session.rollback_to is not None:
+                    await self._rewind(session)
+                    continue
+                names = []
+                for _, file in session.entries[session.merged:session.merged + PREMERGE_CHECKPOINT_EVERY]:
+                    if file not in session.ready and file not in session.spilled:
+                        break
+                    names.append(file)
+                if not names or (len(names) < PREMERGE_CHECKPOINT_EVERY and not final):
+                    break
+                items = [await self._item(session, file) for file in names]
+                last = session.checkpoints[-1][0]
+                checkpoint = None
+                if not final and session.merged + len(names) - last >= max(PREMERGE_CHECKPOINT_EVERY, last):
+                    fd, checkpoint = tempfile.mkstemp(prefix=".premerge-", suffix=".docx", dir=session.workspace)
+                    os.close(fd)
+                session.appending = len(names)
                 try:
-                    doc = Document(file)
-                    doc = check_and_add_title(doc, file)
-                    composer.append(doc)
-                except Exception as e:
-                    print(f"Ошибка добавления файла {file}: {e}")
-                    merged_document.add_paragraph(f"Ошибка добавления файла {os.path.basename(file)}: {e}")
+                    title_times, spans = await run_in_premerge(_premerge_append, session.id, items, names, checkpoint)
+                except BaseException:
+                    if checkpoint:
+                        os.remove(checkpoint)
+                    raise
+                finally:
+                    session.appending = 0
+                # Последние файлы дописываются уже в трассе задачи
+                for seconds in title_times:
+                    TITLE_SECONDS.observe(seconds)
+                for name, start, end, attributes in spans:
+                    tracer.record(name, start, end, attributes, parent=None if final else session.trace)
+                session.merged += len(names)
+                if checkpoint:
+                    if session.rollback_to is not None:
+                        # Пока пачка дописывалась, перед ее файлами встал новый: точка уже неверна
+                        os.remove(checkpoint)
+                    else:
+                        session.checkpoints.append((session.merged, checkpoint))
+                await self._spill(session, names)
         except Exception as e:
-            print(f"Критическая ошибка, невозможно пройтись по списку {file_list}: {e}")
-            merged_document.add_paragraph(f"Критическая ошибка, невозможно пройтись по списку {file_list}: {e}")
-        finally:
-            composer.save(output_file_name)
+            print(f"Ошибка предварительного объединения: {e}")
+            self._fail(session)
+
+    def bind(self, key, task_id):
+        """Передает сессию сбора задаче после ввода имени файла."""
+        session = self.sessions.pop(key, None)
+        if session is not None:
+            self.bound[task_id] = session
+
+    def _fail(self, session):
+        session.failed = True
+        task = asyncio.create_task(self._shutdown(session))
+        self.cleanups.add(task)
+        task.add_done_callback(self.cleanups.discard)
+
+    async def _shutdown(self, session):
+        """Останавливает задачи сессии, закрывает ее документ и удаляет ее файлы."""
+        if session.closed:
+            return
+        session.closed = True
+        current = asyncio.current_task()
+        pending = [task for task in [*session.waiters.values(), *session.tasks] if task is not current]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        session.waiters.clear()
+        if session.opened:
+            try:
+                await run_in_premerge(_premerge_close, session.id)
+            except Exception as e:
+                print(f"Не удалось закрыть документ предварительного объединения: {e}")
+        self.bytes -= session.bytes
+        session.bytes = 0
+        session.ready.clear()
+        for path in [*session.spilled.values(), *(path for _, path in session.checkpoints if path)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        session.spilled.clear()
+        session.checkpoints = [(0, None)]
+
+    def drop(self, key):
+        """Отбрасывает сессию сбора (/cancel, новый /start_merge)."""
+        session = self.sessions.pop(key, None)
+        if session is not None:
+            self._fail(session)
+
+    def drop_task(self, task_id):
+        """Отбрасывает сессию задачи (отмена из очереди, завершение задачи)."""
+        session = self.bound.pop(task_id, None)
+        if session is not None:
+            self._fail(session)
+
+    @timer
+    async def finalize(self, task_id, file_list, output_file_name):
+        """
+        Дописывает оставшиеся файлы и сохраняет итоговый документ.
+        Возвращает имя файла или None, если задачу нужно объединять обычным путем.
+        """
+        session = self.bound.pop(task_id, None)
+        if session is None:
+            return None
+        start_time = time.perf_counter()
+        try:
+            # Ожидание предварительных конвертаций больше не нужно, а начатые пачки дописываем
+            waiters = list(session.waiters.values())
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, *session.tasks, return_exceptions=True)
+            async with session.lock:
+                if session.failed or [file for _, file in session.entries] != list(file_list):
+                    return None
+                # Файлы, которые не успели (или не смогли) сконвертироваться заранее
+                missing = [file for file in file_list if file not in session.ready and file not in session.spilled]
+                for file, item in zip(missing, await process_files(missing) if missing else []):
+                    session.ready[file] = item
+                with tracer.span("premerge.finalize", files=len(file_list) - session.merged, premerged=session.merged):
+                    await self._catch_up(session, final=True)
+                    if session.failed or session.merged != len(file_list):
+                        return None
+                    title_times, spans = await run_in_premerge(_premerge_append, session.id, [], [], output_file_name)
+                    for name, start, end, attributes in spans:
+                        tracer.record(name, start, end, attributes)
+            MERGE_SECONDS.observe(time.perf_counter() - start_time, "premerged")
             print(f"Файлы объединены в {output_file_name}")
             return output_file_name
+        finally:
+            await self._shutdown(session)
 
-    # Объединяем обработанные файлы в отдельном потоке
-    result = await run_in_threadpool(_merge)
-    return result
+premerger = PreMerger(PREMERGE_ENABLED and PROCESS_ROLE == "standalone", PREMERGE_MAX_MB * 1024 * 1024)
+
+# ===================== Рабочие каталоги =====================
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT", "workspaces")  # Можно указать каталог на tmpfs, например /dev/shm/bot
+WORKSPACE_MAX_MB = int(os.getenv("WORKSPACE_MAX_MB", 2048))  # Общий лимит места под файлы пользователей
+WORKSPACE_RESERVE_FACTOR = 4  # Резерв на загруженный файл, итоговый документ, контрольные точки и вытесненные модели
+WORKSPACE_MAX_AGE_HOURS = float(os.getenv("WORKSPACE_MAX_AGE_HOURS", 24))  # Возраст, после которого ничейный каталог удаляется
+WORKSPACE_SWEEP_INTERVAL = int(os.getenv("WORKSPACE_SWEEP_INTERVAL", 600))  # Секунд между проверками
+
+class WorkspaceManager:
+    """
+    Каталоги для файлов: у каждой сессии сбора свой каталог, который затем переходит к задаче.
+    Следит за общим лимитом места (резервирование до загрузки) и удаляет ничейные каталоги,
+    оставшиеся после сбоев, когда они становятся старше max_age.
+    """
+    def __init__(self, root, max_bytes, max_age):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.reserved = {}  # каталог -> зарезервировано байт
+        self.swept = 0
+        os.makedirs(root, exist_ok=True)
+
+    def create(self):
+        """Создает новый каталог и возвращает путь к нему."""
+        workspace = tempfile.mkdtemp(prefix="ws_", dir=self.root)
+        self.reserved[workspace] = 0
+        return workspace
+
+    def claim(self, workspace, file_name):
+        """
+        Атомарно занимает имя файла в каталоге (создает пустой файл), при совпадении добавляя (1), (2)...
+        Возвращает путь к файлу.
+        """
+        base_name, extension = os.path.splitext(file_name)
+        path = os.path.join(workspace, file_name)
+        counter = 1
+        while True:
+            try:
+                open(path, 'xb').close()
+                return path
+            except FileExistsError:
+                path = os.path.join(workspace, f"{base_name}({counter}){extension}")
+                counter += 1
+
+    def used(self):
+        return sum(self.reserved.values())
+
+    def reserve(self, workspace, size):
+        """Резервирует место под файл. False, если общий лимит будет превышен."""
+        size *= WORKSPACE_RESERVE_FACTOR
+        if self.used() + size > self.max_bytes:
+            return False
+        self.reserved[workspace] = self.reserved.get(workspace, 0) + size
+        return True
+
+    def adopt(self, workspace):
+        """Берет под учет существующий каталог (задачи, восстановленной после перезапуска)."""
+        if not workspace or not os.path.isdir(workspace):
+            return
+        size = 0
+        for path, _, files in os.walk(workspace):
+            for name in files:
+                size += os.path.getsize(os.path.join(path, name))
+        self.reserved[workspace] = size * WORKSPACE_RESERVE_FACTOR
+
+    def release(self, workspace):
+        """Удаляет каталог со всеми файлами и освобождает резерв."""
+        if not workspace:
+            return
+        self.reserved.pop(workspace, None)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    def sweep(self):
+        """Удаляет каталоги, которые никому не принадлежат и не менялись дольше max_age."""
+        deadline = time.time() - self.max_age
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.path in self.reserved:
+                    continue
+                try:
+                    if entry.stat().st_mtime < deadline:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        self.swept += 1
+                        print(f"Удален брошенный каталог {entry.path}")
+                except FileNotFoundError:
+                    pass
+
+    async def sweeper(self, interval):
+        """Фоновая очистка ничейных каталогов."""
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Ошибка очистки рабочих каталогов: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {'workspaces': len(self.reserved), 'reserved_bytes': self.used(),
+                'max_bytes': self.max_bytes, 'swept': self.swept}
+
+workspaces = WorkspaceManager(WORKSPACE_ROOT, WORKSPACE_MAX_MB * 1024 * 1024, WORKSPACE_MAX_AGE_HOURS * 3600)
+
+# ===================== Загрузка файлов =====================
+MAX_DOWNLOADS = int(os.getenv("MAX_DOWNLOADS", 8))  # Одновременных загрузок на весь бот
+MAX_DOWNLOADS_PER_USER = int(os.getenv("MAX_DOWNLOADS_PER_USER", 2))  # Одновременных загрузок одного пользователя
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+
+class DownloadManager:
+    """
+    Скачивает файлы из Telegram сразу на диск кусками по DOWNLOAD_CHUNK_SIZE,
+    не держа файл целиком в памяти. Ограничивает число одновременных загрузок
+    (всего и на пользователя) и считает пропускную способность.
+    """
+    def __init__(self, max_downloads, max_per_user, chunk_size):
+        self.semaphore = asyncio.Semaphore(max_downloads)
+        self.max_per_user = max_per_user
+        self.chunk_size = chunk_size
+        self.user_semaphores = {}  # user_id -> Semaphore
+        self.user_pending = {}     # user_id -> загрузок в работе или в ожидании
+        self.active = 0
+        self.downloads = 0
+        self.failed = 0
+        self.total_bytes = 0
+        self.total_seconds = 0.0
+
+    async def download(self, user_id, file_id, destination):
+        """Скачивает файл в destination. Недокачанный файл удаляется."""
+        user_semaphore = self.user_semaphores.setdefault(user_id, asyncio.Semaphore(self.max_per_user))
+        self.user_pending[user_id] = self.user_pending.get(user_id, 0) + 1
+        try:
+            # Сначала ждем очереди пользователя, чтобы не занимать общий слот впустую
+            async with user_semaphore, self.semaphore:
+                self.active += 1
+                start_time = time.perf_counter()
+                try:
+                    file_info = await bot.get_file(file_id)
+                    await bot.download_file(file_info.file_path, destination=destination, chunk_size=self.chunk_size)
+                except BaseException:
+                    self.failed += 1
+                    if os.path.exists(destination):
+                        os.remove(destination)
+                    raise
+                finally:
+                    self.active -= 1
+                elapsed = time.perf_counter() - start_time
+                size = os.path.getsize(destination)
+                self.downloads += 1
+                self.total_bytes += size
+                self.total_seconds += elapsed
+                DOWNLOAD_SECONDS.observe(elapsed)
+                print(f"[PROFILING] Загрузка {os.path.basename(destination)}: {size / 1024 / 1024:.2f} МБ за {elapsed:.2f} секунд")
+        finally:
+            self.user_pending[user_id] -= 1
+            if not self.user_pending[user_id]:
+                del self.user_pending[user_id]
+                del self.user_semaphores[user_id]
+
+    def stats(self):
+        """Счетчики загрузок и средняя пропускная способность (МБ/с)."""
+        throughput = self.total_bytes / self.total_seconds / 1024 / 1024 if self.total_seconds else 0.0
+        return {
+            'active': self.active,
+            'waiting': sum(self.user_pending.values()) - self.active,
+            'downloads': self.downloads,
+            'failed': self.failed,
+            'bytes': self.total_bytes,
+            'seconds': self.total_seconds,
+            'throughput_mb_s': throughput,
+        }
+
+downloads = DownloadManager(MAX_DOWNLOADS, MAX_DOWNLOADS_PER_USER, DOWNLOAD_CHUNK_SIZE)
+
+# ===================== Очередь заданий для воркеров =====================
+BROKER_DB = os.getenv("BROKER_DB", "jobs.db")  # Должен лежать в хранилище, общем с воркерами (как и WORKSPACE_ROOT)
+BROKER_POLL_INTERVAL = float(os.getenv("BROKER_POLL_INTERVAL", 0.5))  # Секунд между проверками очереди
+BROKER_STALE_AFTER = int(os.getenv("BROKER_STALE_AFTER", 60))  # Задание без отметок воркера дольше этого возвращается в очередь
+WORKER_JOBS = int(os.getenv("WORKER_JOBS", 1))  # Сколько заданий воркер выполняет одновременно
+
+class JobBroker:
+    """
+    Очередь заданий "сконвертировать и объединить" между процессом бота и воркерами.
+    Хранится в SQLite; файлы заданий и результат лежат в рабочих каталогах, общих для всех процессов.
+    Воркер, переставший отмечаться дольше stale_after секунд, считается упавшим,
+    и его задание снова выдается другому воркеру.
+    Пока другой процесс держит BEGIN IMMEDIATE, запрос может ждать блокировку до 30 с,
+    поэтому все запросы идут в отдельном потоке (по одному: соединение общее), а не в цикле событий.
+    """
+    def __init__(self, path, stale_after):
+        self.stale_after = stale_after
+        self.thread = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="broker")
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,  -- queued, running, done, failed
+                file_list TEXT NOT NULL,
+                output_path TEXT NOT NULL,
+                worker TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                heartbeat REAL,
+                profile INTEGER NOT NULL DEFAULT 0  -- 1: воркер профилирует задание (/profile)
+            )""")
+        try:
+            # База, созданная до появления профилирования
+            self.db.execute("ALTER TABLE jobs ADD COLUMN profile INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, job_id)")
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.thread, partial(func, *args))
+
+    async def submit(self, job_id, file_list, output_path, profile=False):
+        """Ставит задание (номер — task_id). Уже поставленное до перезапуска бота не дублируется."""
+        await self._call(self._submit, job_id, file_list, output_path, profile)
+
+    def _submit(self, job_id, file_list, output_path, profile):
+        self.db.execute(
+            "INSERT OR IGNORE INTO jobs (job_id, status, file_list, output_path, created, profile) VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, json.dumps(file_list, ensure_ascii=False), output_path, time.time(), int(profile)))
+
+    async def claim(self, worker):
+        """Забирает следующее задание. Возвращает (job_id, file_list, output_path, profile) или None."""
+        return await self._call(self._claim, worker)
+
+    def _claim(self, worker):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat < ?",
+                            (now - self.stale_after,))
+            row = self.db.execute(
+                "SELECT job_id, file_list, output_path, profile FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1").fetchone()
+            if row:
+                self.db.execute("UPDATE jobs SET status = 'running', worker = ?, started = ?, heartbeat = ? WHERE job_id = ?",
+                                (worker, now, now, row[0]))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2], bool(row[3])
+
+    async def heartbeat(self, job_id):
+        await self._call(self.db.execute, "UPDATE jobs SET heartbeat = ? WHERE job_id = ?", (time.time(), job_id))
+
+    async def finish(self, job_id, error=None):
+        await self._call(self.db.execute, "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE job_id = ?",
+                         ('failed' if error else 'done', error, time.time(), job_id))
+
+    async def remove(self, job_id):
+        await self._call(self.db.execute, "DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def _status(self, job_id):
+        return self.db.execute("SELECT status, output_path, error FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+    async def wait(self, job_id, interval):
+        """Ждет завершения задания. Возвращает путь к результату или выбрасывает ошибку воркера."""
+        while True:
+            row = await self._call(self._status, job_id)
+            if row is None:
+                raise RuntimeError(f"задание #{job_id} пропало из очереди")
+            status, output_path, error = row
+            if status == 'done':
+                return output_path
+            if status == 'failed':
+                raise RuntimeError(error)
+            await asyncio.sleep(interval)
+
+broker = JobBroker(BROKER_DB, BROKER_STALE_AFTER) if PROCESS_ROLE != "standalone" else None
+
+async def run_worker():
+    """Основной цикл воркера: забирает задания, конвертирует и объединяет файлы."""
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    await warm_up_executor()
+    print(f"Воркер {name} запущен: {WORKER_JOBS} заданий одновременно")
+
+    async def heartbeat(job_id):
+        while True:
+            await asyncio.sleep(BROKER_STALE_AFTER / 4)
+            await broker.heartbeat(job_id)
+
+    async def worker_loop():
+        while True:
+            job = await broker.claim(name)
+            if job is None:
+                await asyncio.sleep(BROKER_POLL_INTERVAL)
+                continue
+            job_id, file_list, output_path, profile = job
+            print(f"Воркер {name}: задание #{job_id}, {len(file_list)} файлов")
+            beat = asyncio.create_task(heartbeat(job_id))
+            report = ProfileReport(job_id) if profile else None
+            profile_token = current_profile.set(report)
+            try:
+                converted_files = await process_files(file_list)
+                await merge_docx(converted_files, output_path, file_list)
+                if report is not None:
+                    # Сводку забирает и отправляет процесс бота
+                    with open(output_path + PROFILE_SUFFIX, "w", encoding="utf-8") as f:
+                        f.write(report.render(time.time() - report.started))
+                await broker.finish(job_id)
+            except Exception as e:
+                await broker.finish(job_id, str(e) or type(e).__name__)
+            finally:
+                current_profile.reset(profile_token)
+                beat.cancel()
+
+    await asyncio.gather(*(worker_loop() for _ in range(WORKER_JOBS)))
 
 # ===================== FSM: Состояния =====================
 class MergeStates(StatesGroup):
     collecting = State()  # Состояние сбора файлов
     naming_file = State() # Состояние запроса имени файла
 
+# ===================== FSM: Хранилище =====================
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # "sqlite" или "memory"
+FSM_DB = os.getenv("FSM_DB", "fsm.db")
+FSM_SESSION_TTL_HOURS = float(os.getenv("FSM_SESSION_TTL_HOURS", 6))  # Через сколько часов бездействия сбор отменяется
+FSM_EXPIRE_INTERVAL = int(os.getenv("FSM_EXPIRE_INTERVAL", 300))  # Секунд между проверками
+
+class SqliteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite (WAL): начатые сборы файлов переживают перезапуск бота.
+    Все записи держатся в памяти, поэтому чтение не обращается к базе,
+    а каждое изменение сразу записывается. Пустые записи (после state.clear()) удаляются.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self.records = {}  # ключ -> [chat_id, user_id, state, data, updated]
+        for key, chat_id, user_id, state, data, updated in self.db.execute("SELECT * FROM fsm"):
+            self.records[key] = [chat_id, user_id, state, json.loads(data), updated]
+
+    @staticmethod
+    def _key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+
+    def _save(self, name, record):
+        record[4] = time.time()
+        if record[2] is None and not record[3]:
+            self.records.pop(name, None)
+            self.db.execute("DELETE FROM fsm WHERE key = ?", (name,))
+            return
+        self.records[name] = record
+        self.db.execute(
+            "INSERT OR REPLACE INTO fsm (key, chat_id, user_id, state, data, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (name, record[0], record[1], record[2], json.dumps(record[3], ensure_ascii=False), record[4]))
+
+    def _record(self, key):
+        name = self._key(key)
+        record = self.records.get(name)
+        if record is None:
+            record = [key.chat_id, key.user_id, None, {}, 0.0]
+        return name, record
+
+    async def set_state(self, key, state=None):
+        name, record = self._record(key)
+        record[2] = state.state if isinstance(state, State) else state
+        self._save(name, record)
+
+    async def get_state(self, key):
+        record = self.records.get(self._key(key))
+        return record[2] if record else None
+
+    async def set_data(self, key, data):
+        name, record = self._record(key)
+        record[3] = dict(data)
+        self._save(name, record)
+
+    async def get_data(self, key):
+        record = self.records.get(self._key(key))
+        return record[3].copy() if record else {}
+
+    def sessions(self):
+        """Все записи: (ключ, chat_id, user_id, состояние, данные, время изменения)."""
+        return [(name, *record) for name, record in self.records.items()]
+
+    def drop(self, name):
+        self.records.pop(name, None)
+        self.db.execute("DELETE FROM fsm WHERE key = ?", (name,))
+
+    async def close(self):
+        self.db.close()
+
+async def expire_idle_sessions(storage, ttl, interval):
+    """
+    Отменяет сборы файлов, в которых ничего не происходило дольше ttl секунд:
+    удаляет файлы и сообщения бота и возвращает пользователю лимит.
+    """
+    merge_states = (MergeStates.collecting.state, MergeStates.naming_file.state)
+    while True:
+        await asyncio.sleep(interval)
+        deadline = time.time() - ttl
+        for name, chat_id, user_id, state, data, updated in storage.sessions():
+            if state not in merge_states or updated >= deadline:
+                continue
+            storage.drop(name)
+            file_list = data.get('file_list', [])
+            premerger.drop((chat_id, user_id))
+            speculative.discard([file_item[0] for file_item in file_list])
+            workspaces.release(data.get('workspace'))
+            user_limits.discrement_counter(user_id, len(file_list))
+            tracer.end_trace(data.get('trace'), outcome="expired", files=len(file_list))
+            print(f"Сбор файлов пользователя {user_id} в чате {chat_id} отменен по неактивности")
+            try:
+                await del_msg(chat_id, data.get('list_delete_message', []))
+                if chat_id == user_id:
+                    await bot.send_message(chat_id, "Сбор файлов отменен из-за неактивности. Введите /start_merge, чтобы начать заново.",
+                                           reply_markup=ReplyKeyboardRemove())
+            except Exception as e:
+                print(f"Ошибка уведомления об отмене сбора: {e}")
+
 # ===================== Обработчики Telegram-бота =====================
 @router.message(Command("start_merge"))
 async def start_merge(message: Message, state: FSMContext):
@@ -535,15 +3229,21 @@ async def start_merge(message: Message, state: FSMContext):
     if current_state == MergeStates.collecting.state:
         bot_message = await message.answer("Сбор файлов уже запущен.")
         await message.delete()
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+        deletions.schedule(bot_message, delay=5)
         return
 
     # Теперь мы не проверяем, есть ли у пользователя активная задача
     # Просто начинаем новый сбор файлов
 
+    premerger.drop((message.chat.id, message.from_user.id))  # Сессия прошлого сбора, если осталась
+    previous_data = await state.get_data()
+    workspaces.release(previous_data.get('workspace'))
+    tracer.end_trace(previous_data.get('trace'), outcome="abandoned")
     await state.set_state(MergeStates.collecting)
     bot_message = await message.answer("Сбор файлов начат! Отправляйте файлы. Используйте /end_merge для завершения или /cancel для отмены.")
-    await state.update_data(file_list=[], list_delete_message=[bot_message.message_id]) # Создаем пустой список файлов
+    # Создаем пустой список файлов и каталог для них
+    trace = tracer.start_trace("merge_session", **{"chat.id": message.chat.id, "user.id": message.from_user.id})
+    await state.update_data(file_list=[], list_delete_message=[bot_message.message_id], workspace=workspaces.create(), trace=trace)
     await message.delete()
 
 def build_task_status(user_id):
@@ -564,11 +3264,7 @@ def build_task_status(user_id):
         if task_id in task_queue.active_tasks:
             status = "⚙️ Выполняется (отменить невозможно)"
         else:
-            # Ищем позицию в очереди
-            for i, queued_task in enumerate(task_queue.queue):
-                if queued_task['task_id'] == task_id:
-                    status = f"🕒 В очереди (позиция {i+1})"
-                    break
+            status = f"🕒 В очереди (позиция {task_queue.queue.position(task_id)})"
 
         # Создаем имя задачи из первого файла в списке
         task_name = os.path.basename(task['file_list'][0])
@@ -597,7 +3293,7 @@ async def queue_status(message: Message):
     user_id = message.from_user.id
     text, keyboard = build_task_status(user_id)
     bot_message = await message.answer(text, reply_markup=keyboard)
-    asyncio.create_task(delete_message_after_delay(bot_message, delay=300))
+    deletions.schedule(bot_message, delay=300)
     await message.delete()
 
 @router.message(Command("cancel"))
@@ -611,7 +3307,7 @@ async def cancel_collecting(message: Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state != MergeStates.collecting.state:
         bot_message = await message.answer("Сбор файлов не был запущен.")
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+        deletions.schedule(bot_message, delay=5)
         await message.delete()
         return
 
@@ -626,22 +3322,19 @@ async def cancel_collecting(message: Message, state: FSMContext):
     await del_msg(chat_id, list_delete_message)
     user_limits.discrement_counter(user_id, len(file_list))
     max_files = user_limits.max_files
-    if user_id in user_limits.user_data:
-        files_today_count = user_limits.user_data[user_id]['files_today']
-    else:
-        files_today_count = 0
+    files_today_count = user_limits.files_today(user_id)
 
     # Удаляем временные файлы
-    for file_item in file_list:
-        file = file_item[0]
-        if os.path.exists(file):
-            os.remove(file)
+    premerger.drop((message.chat.id, message.from_user.id))
+    speculative.discard([file_item[0] for file_item in file_list])
+    workspaces.release(user_data.get('workspace'))
+    tracer.end_trace(user_data.get('trace'), outcome="cancelled", files=len(file_list))
 
     await state.clear()
     bot_message = await message.answer("Сбор файлов отменен. Все временные файлы удалены.\n"
                   f"Ваш лимит: {files_today_count}/{max_files} (-{len(file_list)})" # Показываем актуальное число
                   )
-    asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+    deletions.schedule(bot_message, delay=5)
     await message.delete()
 
 @router.callback_query(lambda c: c.data.startswith("cancel:"))
@@ -651,37 +3344,31 @@ async def handle_cancel_callback(callback_query: CallbackQuery):
     message = callback_query.message
 
     # Ищем задачу в очереди
-    found = False
-    new_queue = deque()
-    for task in task_queue.queue:
-        if task['task_id'] == task_id:
-            if task['user_id'] == user_id:
-                found = True
-                # Удаляем временные файлы
-                for file in task['file_list']:
-                    if os.path.exists(file):
-                        os.remove(file)
-            else:
-                # Задача существует, но принадлежит другому пользователю
-                await message.answer("Вы не можете отменить чужую задачу")
-                return
-        else:
-            new_queue.append(task)
+    task = task_queue.queue.get(task_id)
+    if task is not None and task['user_id'] != user_id:
+        # Задача существует, но принадлежит другому пользователю
+        await message.answer("Вы не можете отменить чужую задачу")
+        return
+
+    if task is not None:
+        # Убираем задачу из очереди и удаляем временные файлы
+        task_queue.cancel_task(task_id)
+        premerger.drop_task(task_id)
+        speculative.discard(task['file_list'])
+        workspaces.release(task['workspace'])
+        tracer.end_trace(task.get('trace'), outcome="cancelled", files=len(task['file_list']))
 
-    if found:
-        # Обновляем очередь
-        task_queue.queue = new_queue
         text, keyboard = build_task_status(user_id)
         await message.edit_text(text, reply_markup=keyboard)
 
         file_list = task['file_list']
         user_limits.discrement_counter(user_id, len(file_list))
         max_files = user_limits.max_files
-        files_today_count = user_limits.user_data[user_id]['files_today']
+        files_today_count = user_limits.files_today(user_id)
         bot_message = await message.answer("Задача #{task_id} удалена из очереди\n"
             f"Ваш лимит: {files_today_count}/{max_files} (-{len(file_list)})" # Показываем актуальное число
         )
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+        deletions.schedule(bot_message, delay=5)
     else:
         # Проверяем, не выполняется ли задача в данный момент
         if task_id in task_queue.active_tasks and task_queue.active_tasks[task_id]['user_id'] == user_id:
@@ -700,7 +3387,7 @@ async def end_merge(message: Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state != MergeStates.collecting.state:
         bot_message = await message.answer("Сбор файлов не был запущен. Введите /start_merge для начала.")
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+        deletions.schedule(bot_message, delay=5)
         await message.delete()
         return
 
@@ -711,8 +3398,10 @@ async def end_merge(message: Message, state: FSMContext):
 
     if not file_list:
         bot_message = await message.answer("Нет файлов для обработки!")
+        workspaces.release(user_data.get('workspace'))
+        tracer.end_trace(user_data.get('trace'), outcome="empty")
         await state.clear()  # Очищаем состояние
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+        deletions.schedule(bot_message, delay=5)
         await message.delete()
         # Удаляем сохранённые сообщения
         await del_msg(chat_id, list_delete_message)
@@ -762,7 +3451,9 @@ async def process_filename(message: Message, state: FSMContext):
         output_file_name = await sanitize_filename(output_file_name)
 
     # Добавляем задачу в очередь с отсортированным списком файлов
-    task, queue_position = task_queue.add_task(user_id, chat_id, message_thread_id, is_forum, sorted_files, output_file_name)
+    task, queue_position = task_queue.add_task(user_id, chat_id, message_thread_id, is_forum, sorted_files, output_file_name,
+                                               user_data.get('workspace'), user_data.get('trace'))
+    premerger.bind((chat_id, user_id), task['task_id'])
     await message.delete()
 
     if queue_position > 0:
@@ -792,6 +3483,7 @@ async def check_and_process_queue():
             is_forum = task['is_forum']
             file_list = task['file_list']
             output_file_name = task['output_file_name']
+            workspace = task['workspace']
             task_id = task['task_id']
             list_delete_message = task['list_delete_message']
 
@@ -803,16 +3495,41 @@ async def check_and_process_queue():
             bot_message = await bot.send_message(chat_id, f"Начинаю обработку задачи #{task_id} с {len(file_list)} файлами. Это может занять некоторое время...", **send_kwargs )
             list_delete_message.append(bot_message.message_id)
             # Запускаем обработку в фоновом режиме
-            asyncio.create_task(process_and_merge_files_with_queue(chat_id, send_kwargs, file_list, list_delete_message, output_file_name, task_id))
+            asyncio.create_task(process_and_merge_files_with_queue(chat_id, send_kwargs, file_list, list_delete_message, output_file_name, task_id, workspace, task.get('trace')))
 
-async def process_and_merge_files_with_queue(chat_id, send_kwargs, file_list, list_delete_message, output_file_name, task_id):
+async def process_and_merge_files_with_queue(chat_id, send_kwargs, file_list, list_delete_message, output_file_name, task_id, workspace=None, trace=None):
     """
     Асинхронная функция для обработки и объединения файлов с учетом очереди.
     """
+    if workspace is None:
+        workspace = workspaces.create()
+    # Итоговый файл пишется в каталог задачи: одинаковые имена разных задач не пересекаются
+    output_path = os.path.join(workspace, output_file_name)
+    # Спаны задачи (конвертация, объединение, отправка) попадают в трассу сессии
+    trace_token = current_span.set(trace)
+    error = None
+    # Сводка профилирования, если администратор включил /profile
+    report = task_profiler.take(task_id)
+    profile_token = current_profile.set(report)
     try:
-        # Конвертация и объединение файлов
-        converted_files = await process_files(file_list)
-        merged_file = await merge_docx(converted_files, output_file_name)
+        if PROCESS_ROLE == "frontend":
+            # Конвертацию и объединение выполняет воркер, здесь только ждем результат
+            with tracer.span("worker_job", **{"task.id": task_id}):
+                await broker.submit(task_id, file_list, output_path, profile=report is not None)
+                merged_file = await broker.wait(task_id, BROKER_POLL_INTERVAL)
+            if report is not None and os.path.exists(merged_file + PROFILE_SUFFIX):
+                with open(merged_file + PROFILE_SUFFIX, encoding="utf-8") as f:
+                    report.add("Воркер", f.read())
+        elif report is None:
+            # Если файлы объединялись во время сбора, остается только сохранить документ
+            merged_file = await premerger.finalize(task_id, file_list, output_path)
+        else:
+            # Профилируемая задача объединяется заново, чтобы объединение попало в сводку
+            merged_file = None
+        if merged_file is None:
+            # Конвертация и объединение файлов
+            converted_files = await process_files(file_list)
+            merged_file = await merge_docx(converted_files, output_path, file_list)
 
         # Формируем сообщение с информацией о собранных файлах
         file_list_str = "\n".join([os.path.basename(f) for f in file_list])
@@ -821,26 +3538,36 @@ async def process_and_merge_files_with_queue(chat_id, send_kwargs, file_list, li
         # Отправляем объединённый файл пользователю
         document = FSInputFile(merged_file)
         caption = os.path.splitext(output_file_name)[0]
-        await bot.send_document(chat_id, document=document, caption=caption, **send_kwargs)
-
-        # Удаляем объединенный файл после отправки
-        if os.path.exists(merged_file):
-            os.remove(merged_file)
+        start_time = time.perf_counter()
+        with tracer.span("send_document", **{"file.size": os.path.getsize(merged_file)}):
+            await bot.send_document(chat_id, document=document, caption=caption, **send_kwargs)
+        UPLOAD_SECONDS.observe(time.perf_counter() - start_time)
 
     except Exception as e:
+        error = f"{type(e).__name__}: {e}"
         await bot.send_message(chat_id, f"Произошла ошибка при обработке задачи #{task_id}: {str(e)}", **send_kwargs)
 
     finally:
         # Удаляем сохранённые сообщения
         await del_msg(chat_id, list_delete_message)
 
-        # Удаляем файлы, отправленные пользователем
-        for file in file_list:
-            if os.path.exists(file):
-                os.remove(file)
+        # Удаляем файлы, отправленные пользователем, и итоговый файл
+        speculative.discard(file_list)  # На случай ошибки до process_files
+        premerger.drop_task(task_id)
+        if broker is not None:
+            await broker.remove(task_id)
+        workspaces.release(workspace)
 
         # Отмечаем задачу как выполненную
         task_queue.complete_task(task_id)  # Теперь передаю task_id (раньше было user_id)
+        current_span.reset(trace_token)
+        tracer.end_trace(trace, error, outcome="failed" if error else "done", files=len(file_list), **{"task.id": task_id})
+        current_profile.reset(profile_token)
+        if report is not None:
+            try:
+                await task_profiler.deliver(report, time.time() - report.started)
+            except Exception as e:
+                print(f"Не удалось отправить профиль задачи #{task_id}: {e}")
 
         # Проверяем, можно ли обработать следующую задачу
         asyncio.create_task(check_and_process_queue())
@@ -859,48 +3586,56 @@ async def handle_document(message: Message, state: FSMContext):
     if current_state != MergeStates.collecting.state:
         if message.chat.type == "private":
             bot_message = await message.answer("Сбор файлов не запущен. Введите /start_merge для начала.")
-            asyncio.create_task(delete_message_after_delay(bot_message, delay=5))
+            deletions.schedule(bot_message, delay=5)
         return
 
     file_name = message.document.file_name
     file_name = await sanitize_filename(file_name)
-    base_name, extension = os.path.splitext(file_name)
-    counter = 1
+    extension = os.path.splitext(file_name)[1]
 
     if extension.lower() not in (".docx", ".fb2", ".txt", ".epub"):
         bot_message = await message.answer(f"Неизвестный формат файла: {message.document.file_name}. Пожалуйста, отправляйте файлы только в форматах docx, fb2, epub, txt.")
-        asyncio.create_task(delete_message_after_delay(bot_message, delay=10))
+        deletions.schedule(bot_message, delay=10)
         return
 
     user_id = message.from_user.id
     file_size = message.document.file_size
+    session_data = await state.get_data()
+    workspace = session_data.get('workspace')
+    trace = session_data.get('trace')  # Контекст трассы сессии или None
+    if workspace is None:
+        # Сбор начат до появления рабочих каталогов
+        workspace = workspaces.create()
+        await state.update_data(workspace=workspace)
     lock = user_limits.get_lock(user_id) # Получаем блокировку пользователя
 
     async with lock: # Захватываем блокировку (освободится автоматически при выходе из блока)
         is_allowed, error_msg  = user_limits.check_limits(user_id, file_size)
         if not is_allowed:
             bot_message = await message.answer(error_msg)
-            asyncio.create_task(delete_message_after_delay(bot_message, delay=10))
+            deletions.schedule(bot_message, delay=10)
             return # Выходим, блокировка освобождается
 
+        # Проверяем, хватит ли места на диске с учетом уже принятых файлов
+        if not workspaces.reserve(workspace, file_size or 0):
+            bot_message = await message.answer("Сервер сейчас перегружен файлами. Попробуйте отправить файл позже.")
+            deletions.schedule(bot_message, delay=10)
+            return
+
         # Если лимит позволяет, СРАЗУ увеличиваем счетчик ВНУТРИ блокировки
         user_limits.increment_counter(user_id)
         max_files = user_limits.max_files
-        files_today_count = user_limits.user_data[user_id]['files_today']
+        files_today_count = user_limits.files_today(user_id)
 
     # --- Операции вне блокировки (загрузка, сохранение) ---
     try:
-        # Добавляем цифры к имени файла, если нужно, чтобы избежать конфликта между файлами
-        while os.path.exists(file_name):
-            file_name = f"{base_name}({counter}){extension}"
-            counter += 1
+        # Занимаем имя в каталоге сессии (с цифрами, если такое уже есть)
+        file_name = workspaces.claim(workspace, file_name)
 
-        file_info = await bot.get_file(message.document.file_id)
-        downloaded_file = await bot.download_file(file_info.file_path)
-
-        # Сохраняем файл на диск
-        async with aiofiles.open(file_name, 'wb') as new_file:
-            await new_file.write(downloaded_file.read())
+        # Скачиваем файл сразу на диск
+        with tracer.span("upload", parent=trace, **{"file.name": os.path.basename(file_name), "file.size": file_size,
+                                                   "file.format": extension.lower().lstrip(".")}):
+            await downloads.download(user_id, message.document.file_id, file_name)
 
         # Добавляем файл в список вместе с ID сообщения
         user_data = await state.get_data()
@@ -909,10 +3644,17 @@ async def handle_document(message: Message, state: FSMContext):
         # Теперь храним кортеж (имя_файла, id_сообщения)
         file_list.append((file_name, message.message_id))
         await state.update_data(file_list=file_list)
+        # Начинаем конвертацию и объединение, не дожидаясь /end_merge (в трассе сессии)
+        trace_token = current_span.set(trace)
+        try:
+            speculative.schedule(file_name)
+            premerger.add((message.chat.id, message.from_user.id), file_name, message.message_id)
+        finally:
+            current_span.reset(trace_token)
 
         # Сообщаем о лимитах
         bot_message = await message.answer(
-            f"Файл {file_name} сохранён! Всего файлов: {len(file_list)}\n"
+            f"Файл {os.path.basename(file_name)} сохранён! Всего файлов: {len(file_list)}\n"
             f"Использовано сегодня: {files_today_count}/{max_files}" # Показываем актуальное число
         )
         list_delete_message.append(bot_message.message_id)
@@ -947,7 +3689,7 @@ async def send_info(message: Message):
         "/queue_status – статус очереди\n"
         "/cancel – отменить текущий сбор"
     )
-    asyncio.create_task(delete_message_after_delay(bot_message, delay=300))
+    deletions.schedule(bot_message, delay=300)
     await message.delete()
 
 @router.message(Command("limits"))
@@ -966,7 +3708,7 @@ async def check_limits(message: Message):
 
     max_files = user_limits.max_files
     max_size = user_limits.max_size
-    files_used = user_limits.user_data[user_id]['files_today']
+    files_used = user_limits.files_today(user_id)
     files_left = max_files - files_used
 
     bot_message = await message.answer(
@@ -976,17 +3718,213 @@ async def check_limits(message: Message):
         f"• Максимальный размер файла: {max_size} MB\n"
         f"Лимит сбросится в 00:00 UTC (через {hours_left} ч. {minutes_left} мин.)"
     )
-    asyncio.create_task(delete_message_after_delay(bot_message, delay=300))
+    deletions.schedule(bot_message, delay=300)
     await message.delete()
 
+@router.message(Command("profile"))
+async def profile_tasks(message: Message):
+    """
+    Профилирование задач (только для администраторов):
+    /profile N — следующие N задач, /profile N S — следующие N задач дольше S секунд,
+    /profile off — выключить, /profile — состояние.
+    """
+    if await check_sender(message):
+        return
+    if message.from_user.id not in user_limits.admins:
+        return
+
+    args = (message.text or "").split()[1:]
+    if args == ["off"]:
+        task_profiler.disarm()
+        text = "Профилирование выключено."
+    elif args:
+        try:
+            count = int(args[0])
+            threshold = float(args[1]) if len(args) > 1 else 0.0
+            if count <= 0 or threshold < 0:
+                raise ValueError
+        except ValueError:
+            bot_message = await message.answer("Использование: /profile N [секунд] или /profile off")
+            deletions.schedule(bot_message, delay=10)
+            return
+        task_profiler.arm(count, threshold, message.chat.id)
+        if threshold:
+            text = f"Профилирую задачи, пока не наберется {count} дольше {threshold:g} с. Сводки придут в этот чат."
+        else:
+            text = f"Профилирую следующие задачи: {count}. Сводки придут в этот чат."
+    elif task_profiler.remaining:
+        condition = f" дольше {task_profiler.threshold:g} с" if task_profiler.threshold else ""
+        text = f"Профилирование включено: осталось сводок {task_profiler.remaining}{condition}. Отправлено: {task_profiler.delivered}."
+    else:
+        text = f"Профилирование выключено. Отправлено сводок: {task_profiler.delivered}."
+    await message.answer(text)
+
+# ===================== Метрики: состояние и HTTP =====================
+metrics.gauge("bot_queue_depth", "Задач в очереди", lambda: len(task_queue.queue))
+metrics.gauge("bot_active_tasks", "Выполняемых задач", lambda: len(task_queue.active_tasks))
+metrics.gauge("bot_executor_busy", "Вызовов в пуле конвертации (выполняются и ждут)", lambda: executor_busy)
+metrics.gauge("bot_executor_saturation", "Занятость пула конвертации (0..1)", lambda: min(executor_busy, EXECUTOR_WORKERS) / EXECUTOR_WORKERS)
+metrics.gauge("bot_workspace_reserved_bytes", "Место, зарезервированное под файлы пользователей", workspaces.used)
+metrics.gauge("bot_workspace_free_bytes", "Свободное место на диске рабочих каталогов", lambda: shutil.disk_usage(workspaces.root).free)
+metrics.gauge("bot_downloads_active", "Загрузок из Telegram сейчас", lambda: downloads.active)
+metrics.gauge("bot_downloads_waiting", "Загрузок, ждущих своей очереди", lambda: downloads.stats()['waiting'])
+metrics.register(CallbackMetric("bot_downloads_total", "Завершенные загрузки из Telegram", lambda: downloads.downloads, "counter"))
+metrics.register(CallbackMetric("bot_download_failures_total", "Неудачные загрузки из Telegram", lambda: downloads.failed, "counter"))
+# Пропускная способность: rate(bot_download_bytes_total) / rate(bot_download_seconds_total)
+metrics.register(CallbackMetric("bot_download_bytes_total", "Скачано байт из Telegram", lambda: downloads.total_bytes, "counter"))
+metrics.register(CallbackMetric("bot_download_seconds_total", "Время скачивания из Telegram", lambda: downloads.total_seconds, "counter"))
+metrics.gauge("bot_workspaces", "Рабочих каталогов с резервом", lambda: workspaces.stats()['workspaces'])
+metrics.register(CallbackMetric("bot_workspaces_swept_total", "Удаленные ничейные рабочие каталоги", lambda: workspaces.swept, "counter"))
+metrics.gauge("bot_outbound_waiting", "Запросов к Telegram в очереди ограничителя", lambda: rate_limiter.waiting)
+metrics.gauge("bot_deletions_pending", "Сообщений, ожидающих удаления", lambda: deletions.stats()['pending'])
+metrics.gauge("bot_speculative_results_bytes", "Готовые предварительные конвертации в памяти", lambda: speculative.results_bytes)
+metrics.gauge("bot_premerge_bytes", "Модели, ожидающие предварительного объединения", lambda: premerger.bytes)
+metrics.register(CallbackMetric("bot_premerge_fallbacks_total", "Сессии, брошенные из-за лимита памяти предварительного объединения", lambda: premerger.overflows, "counter"))
+metrics.register(CallbackMetric("bot_cache_hits_total", "Попадания в кэш конвертаций", lambda: conversion_cache.stats()['hits'], "counter"))
+metrics.register(CallbackMetric("bot_cache_misses_total", "Промахи кэша конвертаций", lambda: conversion_cache.stats()['misses'], "counter"))
+metrics.register(CallbackMetric("bot_cache_evictions_total", "Вытеснения из кэша конвертаций", lambda: conversion_cache.stats()['evictions'], "counter"))
+metrics.gauge("bot_cache_bytes", "Размер кэша конвертаций", lambda: conversion_cache.stats()['bytes'])
+metrics.register(CallbackMetric("bot_speculative_hits_total", "Задачи, получившие готовую предварительную конвертацию", lambda: speculative.hits, "counter"))
+
+async def handle_metrics(request):
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server(host, port):
+    """Отдельный HTTP-сервер с /metrics (для long polling и воркеров)."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+# ===================== Вебхук =====================
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес бота, например https://example.herokuapp.com; без него — long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))  # Сколько соединений одновременно открывает Telegram
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", 100))  # Сколько обновлений обрабатывается одновременно
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", 8080))  # Heroku передает порт в PORT
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука, который отвечает Telegram сразу, а обновление обрабатывает в фоне.
+    Одновременно обрабатывается не больше max_in_flight обновлений: дальше запросы ждут,
+    и Telegram сам придерживает следующие обновления.
+    """
+    def __init__(self, *args, max_in_flight, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.handled = 0
+
+    async def _background_feed_update(self, bot, update):
+        try:
+            await super()._background_feed_update(bot, update)
+        except Exception as e:
+            print(f"Ошибка обработки обновления: {e}")
+        finally:
+            self.handled += 1
+            self.in_flight.release()
+
+    async def _handle_request_background(self, bot, request):
+        await self.in_flight.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except Exception:
+            # Обновление не запущено — место освобождаем сами
+            self.in_flight.release()
+            raise
+
+    def active(self):
+        return self.max_in_flight - self.in_flight._value
+
+BOT_STARTED = time.time()
+
+async def run_webhook(dp):
+    """Запускает встроенный HTTP-сервер, регистрирует вебхук и работает до остановки."""
+    handler = BoundedRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, max_in_flight=WEBHOOK_MAX_IN_FLIGHT)
+
+    async def health(request):
+        return web.json_response({
+            'status': 'ok',
+            'uptime': round(time.time() - BOT_STARTED),
+            'updates_in_flight': handler.active(),
+            'updates_handled': handler.handled,
+            'queued_tasks': len(task_queue.queue),
+            'active_tasks': len(task_queue.active_tasks),
+            'outbound': rate_limiter.stats(),
+            'deletions': deletions.stats(),
+            'downloads': downloads.stats(),
+            'workspaces': workspaces.stats(),
+        })
+
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/health", health)
+    if not METRICS_PORT:
+        app.router.add_get("/metrics", handle_metrics)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        print(f"Вебхук запущен на {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 # ===================== Запуск бота =====================
 async def main():
-    storage = MemoryStorage()
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if PROCESS_ROLE == "worker":
+        await run_worker()
+        return
+    if bot is None:
+        raise SystemExit("Не задан API_TOKEN")
+    if FSM_STORAGE == "sqlite":
+        storage = SqliteStorage(FSM_DB)
+    else:
+        storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
     dp.include_router(router)
+    if PROCESS_ROLE == "standalone":
+        await warm_up_executor()
+    # Каталоги задач и сборов, переживших перезапуск, не должны считаться брошенными
+    for task in task_queue.queue:
+        workspaces.adopt(task['workspace'])
+    if isinstance(storage, SqliteStorage):
+        for _, _, _, _, data, _ in storage.sessions():
+            workspaces.adopt(data.get('workspace'))
+        asyncio.create_task(expire_idle_sessions(storage, FSM_SESSION_TTL_HOURS * 3600, FSM_EXPIRE_INTERVAL))
+    if isinstance(task_queue, SqliteTaskQueue):
+        task_queue.prune(TASK_HISTORY_DAYS * 86400)
+        if task_queue.recovered:
+            print(f"Восстановлено задач из очереди: {task_queue.recovered}")
+    asyncio.create_task(workspaces.sweeper(WORKSPACE_SWEEP_INTERVAL))
+    asyncio.create_task(deletions.run())
+    asyncio.create_task(user_limits.run_flusher(LIMITS_FLUSH_INTERVAL))
     await set_bot_commands(bot)
+    asyncio.create_task(check_and_process_queue())
     print("Бот запущен.")
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(dp)
+        else:
+            await bot.delete_webhook()  # Иначе getUpdates не работает после запуска в режиме вебхука
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        user_limits.flush()  # Не теряем изменения за последние секунды
+        tracer.flush()
 
 if __name__ == "__main__":
     asyncio.run(main())